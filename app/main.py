@@ -1,14 +1,56 @@
+import argparse
+import asyncio
+import logging
 import os
+import sys
+import tempfile
 
 from dotenv import load_dotenv
 import uvicorn
 
 
 if __name__ == "__main__":
-    load_dotenv("dotenv/fastapi.env", override=True)
-    uvicorn.run(
-        "server.app:app",
-        host=os.environ.get('API_HOST'),
-        port=int(os.environ.get('API_PORT')),
-        reload=True
+    parser = argparse.ArgumentParser(description="Run the Geuebt API")
+    parser.add_argument(
+        "--production", action="store_true",
+        help="Run several worker processes with uvloop and httptools, without reload"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None,
+        help="Worker processes in production mode, defaults to API_WORKERS or the number of cores"
     )
+    args = parser.parse_args()
+
+    load_dotenv("dotenv/fastapi.env", override=True)
+    # Indexes are reconciled once here rather than by every worker
+    from server import metrics, migrate
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    if not asyncio.run(migrate.migrate()):
+        sys.exit(1)
+    host = os.environ.get('API_HOST')
+    port = int(os.environ.get('API_PORT'))
+    if args.production:
+        # Each worker opens its own Mongo connection pool, see MONGO_MAX_POOL_SIZE
+        workers = args.workers or int(os.environ.get('API_WORKERS', 0)) or os.cpu_count()
+        # Read by the workers to size their distance pools, see server/neighbors.py
+        os.environ["API_WORKERS"] = str(workers)
+        # /metrics merges the workers through files, set before they start
+        os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), f"geuebt-metrics-{port}"))
+        metrics.clear_multiprocess_dir()
+        uvicorn.run(
+            "server.app:app",
+            host=host,
+            port=port,
+            workers=workers,
+            loop="uvloop",
+            http="httptools",
+            proxy_headers=True,
+            timeout_graceful_shutdown=30,
+        )
+    else:
+        uvicorn.run(
+            "server.app:app",
+            host=host,
+            port=port,
+            reload=True
+        )
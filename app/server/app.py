@@ -1,25 +1,46 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
 
-from server.database import init_db
+from fastapi import FastAPI, Response
+
+from server.compression import RequestDecompressionMiddleware, ResponseCompressionMiddleware
+from server.database import close_db, init_db, settings
+from server.metrics import MetricsMiddleware, metrics_response
+from server.neighbors import shutdown_pool
 from server.routes.isolates import router as IsolatesRouter
 from server.routes.sequences import router as SequencesRouter
 from server.routes.clusters import router as ClustersRouter
 from server.routes.runs import router as RunRouter
+from server.routes.events import router as EventsRouter
 
 
-app= FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await init_db()
+    yield
+    # Requests in flight are done once the server gets here
+    shutdown_pool()
+    close_db()
+
+
+app= FastAPI(lifespan=lifespan)
+app.add_middleware(ResponseCompressionMiddleware, min_size=settings.RESPONSE_COMPRESSION_MIN_SIZE)
+app.add_middleware(RequestDecompressionMiddleware, max_size=settings.MAX_DECOMPRESSED_REQUEST_SIZE)
+# Added last to run first, sizes are measured on the wire
+app.add_middleware(
+    MetricsMiddleware, slow_request_seconds=settings.SLOW_REQUEST_SECONDS, slow_request_exempt=("/events",)
+)
 app.include_router(IsolatesRouter, tags=["Isolate sheets"], prefix="/isolates")
 app.include_router(SequencesRouter, tags=["Sequence files"], prefix="/sequences")
 app.include_router(ClustersRouter, tags=["Cluster sheets"], prefix="/clusters")
 app.include_router(RunRouter, tags=["Run reports"], prefix="/runs")
-
-
-
-@app.on_event("startup")
-async def start_db():
-    await init_db()
+app.include_router(EventsRouter, tags=["Events"], prefix="/events")
 
 
 @app.get("/")
 async def read_root() -> dict:
     return {"message": "Nothing to do here"}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def read_metrics() -> Response:
+    return metrics_response()
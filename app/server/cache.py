@@ -0,0 +1,126 @@
+import hashlib
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable, NamedTuple, Optional, Tuple, Union
+
+from fastapi import HTTPException, Request, Response
+from pydantic import BaseModel
+
+from server import rawjson
+from server.database import settings
+from server.metrics import timed_serialization
+from server.negotiation import JSON_TYPE, MSGPACK_TYPE, packb, wants_msgpack
+
+
+class CachedBodies(NamedTuple):
+    """Bodies of one version of a document, by media type"""
+    version: tuple
+    bodies: Dict[str, bytes]
+
+
+def make_etag(key: Tuple, version: tuple) -> str:
+    """Strong ETag of one representation of a stored version of a document"""
+    return '"' + hashlib.blake2b(repr((key, version)).encode(), digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        # If-None-Match uses the weak comparison
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+async def stored_version(collection, query: dict, fields: Tuple[str, ...] = ()) -> Optional[tuple]:
+    """
+    Version of a stored document, its _id and the given fields that the
+    writes change, or None if there is no such document. A single indexed
+    lookup that reads no more than these fields.
+    """
+    doc = await collection.find_one(query, {field: 1 for field in fields})
+    if doc is None:
+        return None
+    return (doc["_id"],) + tuple(doc.get(field) for field in fields)
+
+
+class ResponseCache:
+    """
+    LRU of serialized response bodies, keyed by (kind, document ID, variant).
+    An entry holds the JSON and MessagePack bodies of one version of the
+    document, serialized as they are first asked for, and is only served
+    while the stored document still has that version, so writes of any
+    worker are seen at once.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[Tuple, CachedBodies] = OrderedDict()
+
+    def get(self, key: Tuple, version: tuple, media_type: str) -> Optional[bytes]:
+        entry = self.entries.get(key)
+        if entry is None or entry.version != version:
+            return None
+        self.entries.move_to_end(key)
+        return entry.bodies.get(media_type)
+
+    def put(self, key: Tuple, version: tuple, media_type: str, body: bytes) -> None:
+        if self.max_entries <= 0:
+            return
+        entry = self.entries.get(key)
+        if entry is None or entry.version != version:
+            entry = self.entries[key] = CachedBodies(version, {})
+        entry.bodies[media_type] = body
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+
+response_cache = ResponseCache(settings.RESPONSE_CACHE_SIZE)
+
+
+async def cached_response(
+    request: Request,
+    kind: str,
+    doc_id: str,
+    version: Callable[[], Awaitable[Optional[tuple]]],
+    load: Callable[[], Awaitable[Union[BaseModel, dict]]],
+    variant: Hashable = None,
+) -> Response:
+    """
+    Serve a document from the cache, or load and serialize it on a miss.
+    `version` reads the stored version of the document, None if it does not
+    exist; `load` returns a model, or a stored document to send as it is.
+    Bodies are MessagePack when the Accept header prefers it, JSON otherwise,
+    either is encoded directly from the loaded document.
+    Answers 304 when the client already has the current version, without
+    loading the document.
+    """
+    current = await version()
+    if current is None:
+        raise HTTPException(status_code=404, detail="Item not found")
+    media_type = MSGPACK_TYPE if wants_msgpack(request.headers.get("accept")) else JSON_TYPE
+    key = (kind, doc_id, variant)
+    etag = make_etag(key + (media_type,), current)
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    body = response_cache.get(key, current, media_type)
+    if body is None:
+        # A write after the version was read only makes the body newer than
+        # the ETag, the next read sees the new version and loads it again
+        doc = await load()
+        if not isinstance(doc, BaseModel):
+            body = rawjson.packb(doc) if media_type == MSGPACK_TYPE else rawjson.dumps(doc)
+        else:
+            with timed_serialization():
+                if media_type == MSGPACK_TYPE:
+                    body = packb(doc.model_dump(mode="json", by_alias=True))
+                else:
+                    body = doc.model_dump_json(by_alias=True).encode()
+        response_cache.put(key, current, media_type, body)
+    return Response(body, media_type=media_type, headers=headers)
@@ -0,0 +1,189 @@
+import zlib
+from typing import Optional
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import PlainTextResponse
+
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional
+    zstandard = None
+
+
+# Compressed input fed to the decompressor per step, bounds the output of one step
+DECOMPRESS_STEP = 1 << 14
+# Response bytes compressed per step, larger steps run in a worker thread
+COMPRESS_STEP = 1 << 18
+INLINE_COMPRESS_SIZE = 1 << 16
+# Already compressed or streamed event by event
+UNCOMPRESSED_TYPES = ("image/", "video/", "audio/", "application/gzip", "application/zstd", "text/event-stream")
+
+
+def supported_encodings() -> tuple:
+    """Content codings in order of preference"""
+    return ("zstd", "gzip") if zstandard is not None else ("gzip",)
+
+
+def compressor(encoding: str):
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor().compressobj()
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+
+def decompressor(encoding: str):
+    if encoding == "zstd":
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(31)
+
+
+def accepts_encoding(accept_encoding: Optional[str], encoding: str) -> bool:
+    """Whether an Accept-Encoding header allows the given content coding"""
+    for part in (accept_encoding or "").split(","):
+        coding, *params = [item.strip() for item in part.split(";")]
+        if coding.lower() not in (encoding, "*"):
+            continue
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+class RequestDecompressionMiddleware:
+    """
+    Decompresses gzip and zstd request bodies as they are received.
+    Routes read the plain body, a body growing past `max_size` once
+    decompressed is rejected with 413.
+    """
+
+    def __init__(self, app, max_size: int):
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = Headers(scope=scope).get("content-encoding", "identity").strip().lower()
+        if encoding == "identity":
+            return await self.app(scope, receive, send)
+        if encoding not in supported_encodings():
+            response = PlainTextResponse(f"Unsupported Content-Encoding: {encoding}", status_code=415)
+            return await response(scope, receive, send)
+
+        headers = MutableHeaders(scope=scope)
+        del headers["content-encoding"]
+        del headers["content-length"]
+        stream = decompressor(encoding)
+        size = 0
+
+        def decompress(data: bytes) -> bytes:
+            nonlocal size
+            out = []
+            for start in range(0, len(data), DECOMPRESS_STEP):
+                try:
+                    chunk = stream.decompress(data[start:start + DECOMPRESS_STEP])
+                except (zlib.error, getattr(zstandard, "ZstdError", zlib.error)):
+                    raise HTTPException(status_code=400, detail=f"Invalid {encoding} request body")
+                size += len(chunk)
+                if size > self.max_size:
+                    raise HTTPException(status_code=413, detail=f"Request body exceeds {self.max_size} bytes once decompressed")
+                out.append(chunk)
+            return b"".join(out)
+
+        async def decompressing_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                message = {**message, "body": decompress(message.get("body", b""))}
+                # A body cut short would otherwise read as a complete, shorter one
+                if not message.get("more_body", False) and (not stream.eof or stream.unused_data):
+                    raise HTTPException(status_code=400, detail=f"Truncated {encoding} request body, or data after its end")
+            return message
+
+        await self.app(scope, decompressing_receive, send)
+
+
+def _compressed_headers(message, encoding: Optional[str]) -> list:
+    headers = MutableHeaders(raw=list(message["headers"]))
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+        del headers["content-length"]
+    headers.add_vary_header("Accept-Encoding")
+    etag = headers.get("etag")
+    if etag and not etag.startswith("W/"):
+        # The compressed body is a different representation
+        headers["ETag"] = "W/" + etag
+    return headers.raw
+
+
+class ResponseCompressionMiddleware:
+    """
+    Compresses responses with the preferred coding of `Accept-Encoding`,
+    as a stream: bodies go through the compressor in steps, the large ones
+    in a worker thread, and each part of a streamed response is flushed.
+    Responses with their own Content-Encoding and small bodies are sent as is.
+    """
+
+    def __init__(self, app, min_size: int):
+        self.app = app
+        self.min_size = min_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        accept_encoding = Headers(scope=scope).get("accept-encoding")
+        encoding = next((e for e in supported_encodings() if accepts_encoding(accept_encoding, e)), None)
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start_message = None
+        stream = None
+
+        async def compress(data: bytes, more_body: bool) -> bytes:
+            out = []
+            for start in range(0, len(data), COMPRESS_STEP):
+                step = data[start:start + COMPRESS_STEP]
+                if len(step) > INLINE_COMPRESS_SIZE:
+                    out.append(await run_in_threadpool(stream.compress, step))
+                else:
+                    out.append(stream.compress(step))
+            if not more_body:
+                out.append(stream.flush())
+            elif encoding == "zstd":
+                out.append(stream.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK))
+            else:
+                out.append(stream.flush(zlib.Z_SYNC_FLUSH))
+            return b"".join(out)
+
+        async def compressing_send(message):
+            nonlocal start_message, stream
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                content_type = headers.get("content-type", "")
+                if "content-encoding" in headers or content_type.startswith(UNCOMPRESSED_TYPES):
+                    return await send(message)
+                if message["status"] == 304:
+                    # Same validator as the compressed 200 the client holds
+                    return await send({**message, "headers": _compressed_headers(message, None)})
+                # Held back until the first body part shows whether compressing pays off
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or start_message is None and stream is None:
+                return await send(message)
+            body, more_body = message.get("body", b""), message.get("more_body", False)
+            if stream is None:
+                if not more_body and len(body) < self.min_size:
+                    await send(start_message)
+                    start_message = None
+                    return await send(message)
+                stream = compressor(encoding)
+                await send({**start_message, "headers": _compressed_headers(start_message, encoding)})
+                start_message = None
+            await send({"type": "http.response.body", "body": await compress(body, more_body), "more_body": more_body})
+
+        await self.app(scope, receive, compressing_send)
@@ -1,11 +1,16 @@
+from typing import Optional
+
 from beanie import init_beanie
 from pydantic_settings import BaseSettings, SettingsConfigDict
+from pymongo.errors import OperationFailure
 import motor.motor_asyncio
 
+from server import events, metrics, qc
 from server.models.isolates import IsolateSheet
 from server.models.sequences import Sequence
 from server.models.clusters import ClusterSheet
 from server.models.runs import RunReport
+from server.models.loci import LocusSchema
 
 
 doc_models = [
@@ -13,12 +18,41 @@ doc_models = [
     Sequence,
     ClusterSheet,
     RunReport,
+    LocusSchema,
 ]
 
 
 class Settings(BaseSettings):
     MONGO_URL: str
     MONGO_DB: str
+    # Compression of stored sequence files, "gzip" or "zstd"
+    SEQUENCE_COMPRESSION: str = "gzip"
+    # Serialized documents kept for conditional GETs
+    RESPONSE_CACHE_SIZE: int = 1024
+    # Connection pool of each worker process, timeouts in milliseconds
+    MONGO_MAX_POOL_SIZE: int = 100
+    MONGO_MIN_POOL_SIZE: int = 0
+    MONGO_MAX_IDLE_TIME_MS: Optional[int] = None
+    MONGO_WAIT_QUEUE_TIMEOUT_MS: Optional[int] = None
+    MONGO_CONNECT_TIMEOUT_MS: int = 20000
+    MONGO_SOCKET_TIMEOUT_MS: Optional[int] = None
+    MONGO_SERVER_SELECTION_TIMEOUT_MS: int = 30000
+    # "primary", "primaryPreferred", "secondary", "secondaryPreferred" or "nearest"
+    MONGO_READ_PREFERENCE: str = "primary"
+    # Write concern, a number of nodes or "majority", and journal acknowledgment
+    MONGO_WRITE_CONCERN: str = "1"
+    MONGO_JOURNAL: Optional[bool] = None
+    # Limit of gzip / zstd request bodies once decompressed, in bytes
+    MAX_DECOMPRESSED_REQUEST_SIZE: int = 256 * 1024 * 1024
+    # Smaller responses are sent uncompressed
+    RESPONSE_COMPRESSION_MIN_SIZE: int = 1024
+    # Requests taking longer are logged with their time in Mongo, unset to disable
+    SLOW_REQUEST_SECONDS: Optional[float] = 1.0
+    # Source of /events: "change_stream", "log" (capped collection shared by the workers),
+    # "bus" (writes of this process, single worker only) or "auto" (change streams if available, else the log)
+    EVENT_SOURCE: str = "auto"
+    # Events the bus keeps for clients resuming from an earlier position
+    EVENT_BUFFER_SIZE: int = 10000
 
     model_config = SettingsConfigDict(
         env_file='dotenv/fastapi.env',
@@ -28,13 +62,57 @@ class Settings(BaseSettings):
 
 
 settings = Settings()
+client: Optional[motor.motor_asyncio.AsyncIOMotorClient] = None
 
 
-async def init_db():
+def client_options() -> dict:
+    """Keyword arguments of the Mongo client, options left unset keep the driver defaults"""
+    write_concern = settings.MONGO_WRITE_CONCERN
+    options = {
+        "maxPoolSize": settings.MONGO_MAX_POOL_SIZE,
+        "minPoolSize": settings.MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": settings.MONGO_MAX_IDLE_TIME_MS,
+        "waitQueueTimeoutMS": settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        "connectTimeoutMS": settings.MONGO_CONNECT_TIMEOUT_MS,
+        "socketTimeoutMS": settings.MONGO_SOCKET_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "readPreference": settings.MONGO_READ_PREFERENCE,
+        "w": int(write_concern) if write_concern.isdigit() else write_concern,
+        "journal": settings.MONGO_JOURNAL,
+    }
+    return {key: value for key, value in options.items() if value is not None}
+
+
+def connect() -> motor.motor_asyncio.AsyncIOMotorClient:
+    global client
     client = motor.motor_asyncio.AsyncIOMotorClient(
-        settings.MONGO_URL
-    )
-    await init_beanie(
-        database=client[settings.MONGO_DB],
-        document_models=doc_models
+        settings.MONGO_URL, event_listeners=[metrics.CommandTimer()], **client_options()
     )
+    return client
+
+
+async def init_db():
+    connect()
+    # Indexes are declared in the document models. Every worker creates the
+    # missing ones, dropping outdated ones is left to `python -m server.migrate`
+    try:
+        await init_beanie(
+            database=client[settings.MONGO_DB],
+            document_models=doc_models,
+        )
+    except OperationFailure as e:
+        if e.code == 11000:
+            raise RuntimeError(
+                f"A unique index cannot be built over duplicate documents ({e}), "
+                "run `python -m server.migrate --dedupe`"
+            ) from e
+        raise
+    await qc.load_rules(client[settings.MONGO_DB])
+    await events.start(client[settings.MONGO_DB], settings.EVENT_SOURCE, settings.EVENT_BUFFER_SIZE)
+
+
+def close_db():
+    global client
+    if client is not None:
+        client.close()
+        client = None
@@ -0,0 +1,324 @@
+import asyncio
+import datetime
+import logging
+import secrets
+import time
+from collections import deque
+from typing import AsyncIterator, Collection, List, Optional, Tuple
+
+from fastapi import HTTPException
+from pymongo import ASCENDING, DESCENDING, CursorType
+from pymongo.errors import BulkWriteError, CollectionInvalid, OperationFailure
+
+
+logger = logging.getLogger(__name__)
+
+KINDS = ("isolate", "profile", "cluster", "sequence", "run")
+# Longest wait of a feed before it hands back an empty batch
+POLL_SECONDS = 1.0
+DEFAULT_BUFFER_SIZE = 10000
+# Capped collection of the event log, and room per event in bytes
+EVENT_COLLECTION = "events"
+EVENT_LOG_BYTES = 1024
+
+# Watched collections, the kind of their events and the path of the document ID
+_COLLECTIONS = {
+    "isolates": ("isolate", ("isolate_id",)),
+    "sequences": ("sequence", ("isolate_id",)),
+    "clusters": ("cluster", ("cluster_id",)),
+    "runs": ("run", ("run_metadata", "name")),
+}
+_PIPELINE = [
+    {"$match": {
+        "ns.coll": {"$in": list(_COLLECTIONS)},
+        "operationType": {"$in": ["insert", "update", "replace"]},
+    }},
+    # Only the IDs travel, an isolate update that sets cgmlst is a profile event
+    {"$project": {
+        "operationType": 1,
+        "ns.coll": 1,
+        "clusterTime": 1,
+        "fullDocument.isolate_id": 1,
+        "fullDocument.cluster_id": 1,
+        "fullDocument.run_metadata.name": 1,
+        "profile": {"$in": ["cgmlst", {"$map": {
+            "input": {"$objectToArray": {"$ifNull": ["$updateDescription.updatedFields", {}]}},
+            "in": {"$arrayElemAt": [{"$split": ["$$this.k", "."]}, 0]},
+        }}]},
+    }},
+]
+
+Batch = Tuple[List[dict], str]
+
+
+def _gone(since: str) -> HTTPException:
+    return HTTPException(
+        status_code=410,
+        detail=f"Events since {since} are no longer available, read the current state and resume from a new position",
+    )
+
+
+def _event(event_id: str, kind: str, op: str, doc_id: str, at: datetime.datetime) -> dict:
+    return {"id": event_id, "kind": kind, "op": op, "doc_id": doc_id, "time": at.isoformat()}
+
+
+class EventBus:
+    """
+    Events published by the route handlers of this process, kept in a ring
+    buffer of `size` events. Positions are `<boot>.<sequence>`, a position
+    from before a restart or older than the buffer cannot be resumed.
+    Only fit for a single worker, the others' writes are not seen.
+    """
+
+    source = "bus"
+
+    def __init__(self, size: int):
+        self.boot = secrets.token_hex(4)
+        self.sequence = 0
+        self.events: deque = deque(maxlen=size)
+        self._wakeup = asyncio.Event()
+
+    def _position(self, since: Optional[str]) -> int:
+        if since is None:
+            return self.sequence
+        boot, _, sequence = since.partition(".")
+        if boot != self.boot or not sequence.isdigit():
+            raise _gone(since)
+        position = int(sequence)
+        if position > self.sequence:
+            raise _gone(since)
+        return position
+
+    async def publish(self, kind: str, op: str, doc_ids: Collection[str]) -> None:
+        at = datetime.datetime.now(datetime.timezone.utc)
+        for doc_id in doc_ids:
+            self.sequence += 1
+            event = _event(f"{self.boot}.{self.sequence}", kind, op, doc_id, at)
+            self.events.append({"seq": self.sequence, "event": event})
+        # Waiters hold the previous event, a new one is handed out for the next publish
+        self._wakeup.set()
+        self._wakeup = asyncio.Event()
+
+    def _after(self, position: int, kinds: Collection[str], limit: int) -> Batch:
+        events = []
+        if not self.events:
+            return events, position
+        start = position - self.events[0]["seq"] + 1
+        if start < 0:
+            # Fell behind by more than the buffer
+            raise _gone(f"{self.boot}.{position}")
+        for index in range(start, len(self.events)):
+            item = self.events[index]
+            position = item["seq"]
+            if item["event"]["kind"] in kinds:
+                events.append(item["event"])
+                if len(events) >= limit:
+                    break
+        return events, position
+
+    async def subscribe(self, since: Optional[str], kinds: Collection[str], limit: int) -> AsyncIterator[Batch]:
+        """
+        Batches of events after `since`, or after the current position, with
+        the position they end at. The first batch comes at once, the others
+        as events arrive or empty every POLL_SECONDS.
+        """
+        position = self._position(since)
+        while True:
+            wakeup = self._wakeup
+            events, position = self._after(position, kinds, limit)
+            yield events, f"{self.boot}.{position}"
+            if position >= self.sequence:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+
+
+async def _next(cursor) -> Optional[dict]:
+    """Next document of a tailable cursor, None once a wait for more ends empty"""
+    try:
+        return await cursor.next()
+    except StopAsyncIteration:
+        return None
+
+
+class EventLog:
+    """
+    Events published by the route handlers of every worker, in a capped
+    collection of `size` events that the workers tail. Positions are
+    sequence numbers: a writer takes the numbers after the last one it
+    sees and retries on a duplicate, so numbers have no gaps and are
+    written in order.
+    """
+
+    source = "log"
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    @classmethod
+    async def open(cls, database, size: int) -> "EventLog":
+        try:
+            await database.create_collection(EVENT_COLLECTION, capped=True, size=size * EVENT_LOG_BYTES, max=size)
+        except CollectionInvalid:
+            # Created by another worker or an earlier run
+            pass
+        return cls(database[EVENT_COLLECTION])
+
+    async def _edge(self, direction: int) -> int:
+        doc = await self.collection.find_one({}, {"_id": 1}, sort=[("_id", direction)])
+        return doc["_id"] if doc else 0
+
+    async def publish(self, kind: str, op: str, doc_ids: Collection[str]) -> None:
+        at = datetime.datetime.now(datetime.timezone.utc)
+        pending = list(doc_ids)
+        while pending:
+            first = await self._edge(DESCENDING) + 1
+            try:
+                await self.collection.insert_many([
+                    {"_id": first + i, "kind": kind, "op": op, "doc_id": doc_id, "time": at}
+                    for i, doc_id in enumerate(pending)
+                ])
+                return
+            except BulkWriteError as e:
+                if any(err["code"] != 11000 for err in e.details["writeErrors"]):
+                    raise
+                # Another worker took a number first, the events written so far stay
+                pending = pending[e.details["nInserted"]:]
+
+    @staticmethod
+    def _convert(doc: dict) -> dict:
+        at = doc["time"].replace(tzinfo=datetime.timezone.utc)
+        return _event(str(doc["_id"]), doc["kind"], doc["op"], doc["doc_id"], at)
+
+    async def subscribe(self, since: Optional[str], kinds: Collection[str], limit: int) -> AsyncIterator[Batch]:
+        """
+        Batches of events after `since`, or after the current position, with
+        the position they end at. The first batch comes at once, the others
+        as events arrive or empty every POLL_SECONDS.
+        """
+        last = await self._edge(DESCENDING)
+        if since is None:
+            position = last
+        elif not since.isdigit() or int(since) > last or int(since) < await self._edge(ASCENDING) - 1:
+            raise _gone(since)
+        else:
+            position = int(since)
+        try:
+            while True:
+                cursor = self.collection.find(
+                    {"_id": {"$gt": position}}, cursor_type=CursorType.TAILABLE_AWAIT
+                ).max_await_time_ms(int(POLL_SECONDS * 1000))
+                while cursor.alive:
+                    events = []
+                    deadline = time.monotonic() + POLL_SECONDS
+                    while len(events) < limit and time.monotonic() < deadline:
+                        doc = await _next(cursor)
+                        if doc is None:
+                            break
+                        position = doc["_id"]
+                        if doc["kind"] in kinds:
+                            events.append(self._convert(doc))
+                    yield events, str(position)
+                # The cursor of an empty collection dies at once
+                await asyncio.sleep(POLL_SECONDS)
+        except OperationFailure as e:
+            if e.code == 136:
+                # CappedPositionLost, the reader fell behind by more than the log
+                raise _gone(str(position))
+            raise
+
+
+class ChangeStreamFeed:
+    """
+    Events from a change stream on the database, which sees the writes of every
+    worker and of other clients. Positions are change stream resume tokens.
+    """
+
+    source = "change_stream"
+
+    def __init__(self, database):
+        self.database = database
+
+    async def publish(self, kind: str, op: str, doc_ids: Collection[str]) -> None:
+        # The change stream reports the write itself
+        pass
+
+    @staticmethod
+    def _convert(change: dict) -> Optional[dict]:
+        kind, path = _COLLECTIONS[change["ns"]["coll"]]
+        if kind == "isolate" and change.get("profile"):
+            kind = "profile"
+        doc_id = change.get("fullDocument")
+        for key in path:
+            doc_id = doc_id.get(key) if isinstance(doc_id, dict) else None
+        if doc_id is None:
+            # Deleted before the update was looked up
+            return None
+        op = "insert" if change["operationType"] == "insert" else "update"
+        return _event(change["_id"]["_data"], kind, op, doc_id, change["clusterTime"].as_datetime())
+
+    async def subscribe(self, since: Optional[str], kinds: Collection[str], limit: int) -> AsyncIterator[Batch]:
+        """
+        Batches of events after `since`, or after the current position, with
+        the position they end at. A batch is handed back once it holds `limit`
+        events or the stream has nothing more, at least every POLL_SECONDS.
+        """
+        if since is not None:
+            try:
+                bytes.fromhex(since)
+            except ValueError:
+                raise _gone(since)
+        options = {"resume_after": {"_data": since}} if since is not None else {}
+        try:
+            async with self.database.watch(
+                _PIPELINE, full_document="updateLookup", max_await_time_ms=int(POLL_SECONDS * 1000), **options
+            ) as stream:
+                while stream.alive:
+                    events = []
+                    deadline = time.monotonic() + POLL_SECONDS
+                    while len(events) < limit and time.monotonic() < deadline:
+                        change = await stream.try_next()
+                        if change is None:
+                            break
+                        event = self._convert(change)
+                        if event is not None and event["kind"] in kinds:
+                            events.append(event)
+                    yield events, stream.resume_token["_data"]
+        except OperationFailure as e:
+            if since is not None and e.code in (260, 280, 286):
+                # Invalid resume token, or history no longer in the oplog
+                raise _gone(since)
+            raise
+
+
+feed = EventBus(DEFAULT_BUFFER_SIZE)
+
+
+async def publish(kind: str, op: str, *doc_ids: str) -> None:
+    """Announce inserts or updates of documents, unless the change stream does"""
+    await feed.publish(kind, op, doc_ids)
+
+
+async def start(database, source: str = "auto", buffer_size: int = DEFAULT_BUFFER_SIZE) -> None:
+    """
+    Use change streams when `source` is "change_stream", or "auto" and the
+    server supports them (replica sets and sharded clusters), else the event
+    log shared by the workers. The "bus" source keeps events in this process.
+    """
+    global feed
+    if source == "bus":
+        feed = EventBus(buffer_size)
+        logger.warning("EVENT_SOURCE=bus: /events only reports the writes of this process, run a single worker")
+        return
+    if source != "log":
+        try:
+            async with database.watch(_PIPELINE, max_await_time_ms=1) as stream:
+                await stream.try_next()
+            feed = ChangeStreamFeed(database)
+            return
+        except (OperationFailure, NotImplementedError) as e:
+            if source == "change_stream":
+                raise
+            logger.info("Change streams unavailable (%s), events go through the %s collection", e, EVENT_COLLECTION)
+    feed = await EventLog.open(database, buffer_size)
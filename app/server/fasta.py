@@ -0,0 +1,187 @@
+import hashlib
+from typing import AsyncIterator, List, Optional, Tuple
+
+import numpy as np
+from bson import ObjectId
+from fastapi import HTTPException
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket, AsyncIOMotorGridOut
+from starlette.concurrency import run_in_threadpool
+
+from server.compression import compressor, decompressor, zstandard
+from server.database import settings
+from server.models.sequences import Sequence
+
+
+BUCKET_NAME = "sequence_files"
+# Uncompressed bytes handed to the compressor per step
+FASTA_CHUNK_SIZE = 1 << 20
+# Size of the GridFS chunk documents
+GRIDFS_CHUNK_SIZE = 1 << 20
+# Longest accepted header line, bounds the only buffered part of an upload
+MAX_HEADER_LENGTH = 1 << 16
+FASTA_TYPES = ("text/x-fasta", "text/plain", "application/octet-stream")
+# IUPAC nucleotide codes, gaps and line ending leftovers
+_SEQUENCE_CHARS = b"ACGTUNRYKMSWBDHVacgtunrykmswbdhv-.\r"
+
+
+def get_bucket() -> AsyncIOMotorGridFSBucket:
+    return AsyncIOMotorGridFSBucket(
+        Sequence.get_motor_collection().database,
+        bucket_name=BUCKET_NAME,
+        chunk_size_bytes=GRIDFS_CHUNK_SIZE,
+    )
+
+
+def storage_encoding() -> str:
+    """Compression of newly stored files, gzip unless zstd is configured and installed"""
+    if settings.SEQUENCE_COMPRESSION == "zstd" and zstandard is not None:
+        return "zstd"
+    return "gzip"
+
+
+async def iter_text_chunks(text: str) -> AsyncIterator[bytes]:
+    data = text.encode()
+    for start in range(0, len(data), FASTA_CHUNK_SIZE):
+        yield data[start:start + FASTA_CHUNK_SIZE]
+
+
+def _malformed(msg: str) -> HTTPException:
+    return HTTPException(status_code=400, detail=f"Malformed FASTA: {msg}")
+
+
+class FastaChecker:
+    """
+    Validates a FASTA stream record by record while passing it through,
+    hashing it and collecting contig lengths. Only header lines are buffered.
+    """
+
+    def __init__(self, expected_md5: Optional[str] = None):
+        self.expected_md5 = expected_md5
+        self.md5 = hashlib.md5()
+        self.lengths: List[int] = []
+        self._header: Optional[bytearray] = None
+        self._line_start = True
+
+    def _close_record(self) -> None:
+        if self.lengths and self.lengths[-1] == 0:
+            raise _malformed(f"record {len(self.lengths)} has no sequence")
+
+    def _sequence(self, data: bytes) -> None:
+        if not data:
+            return
+        if not self.lengths:
+            raise _malformed("sequence found before the first '>' header")
+        if data.translate(None, _SEQUENCE_CHARS):
+            raise _malformed(f"invalid characters in the sequence of record {len(self.lengths)}")
+        self.lengths[-1] += len(data) - data.count(b"\r")
+
+    def _header_end(self) -> None:
+        if not self._header.split():
+            raise _malformed(f"record {len(self.lengths)} has an empty header")
+        self._header = None
+
+    def feed(self, chunk: bytes) -> None:
+        self.md5.update(chunk)
+        if self._header is None and b">" not in chunk:
+            # Sequence lines only, checked in one pass
+            self._sequence(chunk.replace(b"\n", b""))
+            if chunk:
+                self._line_start = chunk.endswith(b"\n")
+            return
+        *lines, last = chunk.split(b"\n")
+        for segment, ended in [(line, True) for line in lines] + [(last, False)]:
+            if self._header is not None:
+                self._header += segment
+                if len(self._header) > MAX_HEADER_LENGTH:
+                    raise _malformed(f"header of record {len(self.lengths)} is too long")
+            elif self._line_start and segment.startswith(b">"):
+                self._close_record()
+                self.lengths.append(0)
+                self._header = bytearray(segment[1:])
+            else:
+                self._sequence(segment)
+            if ended:
+                if self._header is not None:
+                    self._header_end()
+                self._line_start = True
+            elif segment:
+                self._line_start = False
+
+    def finish(self) -> None:
+        """Check the end of the file and the MD5 once the stream is exhausted"""
+        if self._header is not None:
+            self._header_end()
+        if not self.lengths:
+            raise _malformed("no records found")
+        self._close_record()
+        if self.expected_md5 and self.md5.hexdigest() != self.expected_md5.lower():
+            raise HTTPException(
+                status_code=422,
+                detail=f"MD5 mismatch: received {self.md5.hexdigest()}, isolate sheet has {self.expected_md5}",
+            )
+
+    async def check(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        async for chunk in chunks:
+            self.feed(chunk)
+            yield chunk
+        self.finish()
+
+    def stats(self) -> dict:
+        lengths = sorted(self.lengths, reverse=True)
+        total = sum(lengths)
+        # N50: length of the contig that brings the cumulative length past half the assembly
+        cumulative = np.cumsum(lengths)
+        n50 = lengths[int(np.searchsorted(cumulative, total / 2))]
+        return {
+            "contigs": len(lengths),
+            "total_length": total,
+            "min_length": lengths[-1],
+            "max_length": lengths[0],
+            "n50": n50,
+        }
+
+
+async def store_fasta(isolate_id: str, chunks: AsyncIterator[bytes]) -> Tuple[ObjectId, int, str]:
+    """
+    Compress a sequence file into GridFS as it is read.
+    Returns the file ID, the uncompressed length and the encoding.
+    """
+    encoding = storage_encoding()
+    stream = compressor(encoding)
+    grid_in = get_bucket().open_upload_stream(
+        f"{isolate_id}.fa",
+        metadata={"isolate_id": isolate_id, "encoding": encoding},
+    )
+    length = 0
+    try:
+        async for chunk in chunks:
+            length += len(chunk)
+            await grid_in.write(await run_in_threadpool(stream.compress, chunk))
+        await grid_in.write(stream.flush())
+    except BaseException:
+        await grid_in.abort()
+        raise
+    await grid_in.close()
+    return grid_in._id, length, encoding
+
+
+async def open_fasta(file_id: ObjectId) -> AsyncIOMotorGridOut:
+    return await get_bucket().open_download_stream(file_id)
+
+
+async def iter_fasta(
+    grid_out: AsyncIOMotorGridOut, encoding: str, decompress: bool = True
+) -> AsyncIterator[bytes]:
+    """Read a stored file chunk by chunk, decompressed unless `decompress` is False"""
+    stream = decompressor(encoding) if decompress else None
+    while chunk := await grid_out.readchunk():
+        if stream is not None:
+            chunk = await run_in_threadpool(stream.decompress, chunk)
+        if chunk:
+            yield chunk
+    if stream is not None and (tail := stream.flush()):
+        yield tail
+
+
+async def delete_fasta(file_id: ObjectId) -> None:
+    await get_bucket().delete(file_id)
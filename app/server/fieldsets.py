@@ -0,0 +1,116 @@
+import functools
+import types
+import typing
+from typing import Dict, FrozenSet, List, Optional, Tuple, Type
+
+from fastapi import HTTPException
+from pydantic import BaseModel, create_model
+
+
+Paths = FrozenSet[Tuple[str, ...]]
+
+
+def parse_fields(value: Optional[str]) -> Optional[Paths]:
+    """Comma separated, dot notation field paths of a query parameter"""
+    paths = {tuple(path.strip().split(".")) for path in (value or "").split(",") if path.strip()}
+    # A field also covers its subfields, Mongo rejects overlapping paths
+    paths = frozenset(path for path in paths if not any(path[:i] in paths for i in range(1, len(path))))
+    return paths or None
+
+
+def _unwrap(annotation) -> Tuple[Optional[Type[BaseModel]], list]:
+    """Model type nested in Optional / List annotations, and the wrappers to re-apply"""
+    wrappers = []
+    while True:
+        if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+            return annotation, wrappers
+        args = [arg for arg in typing.get_args(annotation) if arg is not type(None)]
+        origin = typing.get_origin(annotation)
+        if len(args) != 1 or origin not in (typing.Union, types.UnionType, list):
+            return None, wrappers
+        wrappers.append(origin)
+        annotation = args[0]
+
+
+def _rewrap(model: Type[BaseModel], wrappers: list):
+    annotation = model
+    for origin in reversed(wrappers):
+        annotation = List[annotation] if origin is list else Optional[annotation]
+    return annotation
+
+
+def _split(paths: Paths) -> Dict[str, Paths]:
+    children: Dict[str, set] = {}
+    for head, *rest in paths:
+        children.setdefault(head, set())
+        if rest:
+            children[head].add(tuple(rest))
+    return {name: frozenset(rest) for name, rest in children.items()}
+
+
+def _check(model: Type[BaseModel], paths: Paths, prefix: str = "") -> None:
+    for name, rest in _split(paths).items():
+        field = model.model_fields.get(name)
+        if field is None or field.exclude:
+            raise HTTPException(status_code=422, detail=f"Unknown field: {prefix}{name}")
+        if rest:
+            nested, _ = _unwrap(field.annotation)
+            if nested is None:
+                raise HTTPException(status_code=422, detail=f"Field has no subfields: {prefix}{name}")
+            _check(nested, rest, f"{prefix}{name}.")
+
+
+@functools.lru_cache(maxsize=256)
+def _projected_model(model: Type[BaseModel], include: Optional[Paths], exclude: Paths) -> Type[BaseModel]:
+    included = _split(include) if include is not None else None
+    excluded = _split(exclude)
+    fields = {}
+    for name, field in model.model_fields.items():
+        if field.exclude:
+            continue
+        if included is not None and name not in included:
+            continue
+        if name in excluded and not excluded[name]:
+            continue
+        sub_include = included[name] if included is not None and included[name] else None
+        sub_exclude = excluded.get(name, frozenset())
+        if sub_include is None and not sub_exclude:
+            fields[name] = (field.annotation, field)
+            continue
+        nested, wrappers = _unwrap(field.annotation)
+        annotation = _rewrap(_projected_model(nested, sub_include, sub_exclude), wrappers)
+        fields[name] = (annotation, field.default if not field.is_required() else ...)
+    return create_model(f"{model.__name__}Fields", **fields)
+
+
+def projection(
+    model: Type[BaseModel], fields: Optional[str], exclude: Optional[str]
+) -> Tuple[Optional[dict], Type[BaseModel]]:
+    """
+    Mongo projection and response model for the `fields` / `exclude` query
+    parameters. The response model keeps only the selected fields and none
+    of the document validators. Returns (None, model) without a fieldset.
+    """
+    include_paths, exclude_paths = parse_fields(fields), parse_fields(exclude)
+    if include_paths is None and exclude_paths is None:
+        return None, model
+    if include_paths is not None and exclude_paths is not None:
+        raise HTTPException(status_code=422, detail="Use either fields or exclude, not both")
+    paths = include_paths if include_paths is not None else exclude_paths
+    _check(model, paths)
+    value = 1 if include_paths is not None else 0
+    query = {".".join(_aliased(model, path)): value for path in paths}
+    if value and "_id" not in query:
+        # Mongo returns _id unless told otherwise
+        query["_id"] = 0
+    return query, _projected_model(model, include_paths, exclude_paths or frozenset())
+
+
+def _aliased(model: Type[BaseModel], path: Tuple[str, ...]) -> List[str]:
+    """Stored names of a field path, `id` is stored as `_id`"""
+    names = []
+    for name in path:
+        field = model.model_fields[name]
+        names.append(field.alias or name)
+        model, _ = _unwrap(field.annotation)
+    return names
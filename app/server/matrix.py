@@ -0,0 +1,203 @@
+import io
+import zipfile
+import zlib
+from typing import AsyncIterator, List, Optional, Tuple
+
+import numpy as np
+from bson import ObjectId
+from starlette.concurrency import run_in_threadpool
+
+from server.models.isolates import IsolateSheet
+from server.profiles import MISSING_ALLELE, PROFILE_DTYPE, fill_profile_row, get_positions
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:  # Arrow export is optional
+    pa = None
+
+
+# Isolates decoded and encoded per step, bounds the memory of an export
+MATRIX_CHUNK_SIZE = 256
+
+NPZ_TYPE = "application/x-npz"
+ARROW_TYPE = "application/vnd.apache.arrow.stream"
+TSV_GZ_TYPE = "application/gzip"
+# Accepted media types, the first one is the default. A bare .npy array
+# cannot carry the locus names and isolate IDs, it is answered with .npz
+MATRIX_TYPES = {
+    NPZ_TYPE: NPZ_TYPE,
+    "application/x-npy": NPZ_TYPE,
+    ARROW_TYPE: ARROW_TYPE,
+    TSV_GZ_TYPE: TSV_GZ_TYPE,
+    "text/tab-separated-values": TSV_GZ_TYPE,
+}
+
+
+def negotiate(accept: Optional[str]) -> Optional[str]:
+    """Pick the export format from an Accept header, None if nothing matches"""
+    if not accept:
+        return NPZ_TYPE
+    offers = []
+    for position, part in enumerate(accept.split(",")):
+        media_type, *params = [item.strip() for item in part.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            offers.append((-quality, position, media_type.lower()))
+    for _, _, media_type in sorted(offers):
+        if media_type in MATRIX_TYPES:
+            return MATRIX_TYPES[media_type]
+        if media_type in ("*/*", "application/*"):
+            return NPZ_TYPE
+    return None
+
+
+def _profiles_filter(species: str) -> dict:
+    return {"organism": species, "cgmlst.allele_profile": {"$exists": True}}
+
+
+async def profiled_isolates(species: str) -> Tuple[List[ObjectId], List[str]]:
+    """
+    _id and isolate ID of the isolates with a profile, in _id order. Read
+    once before an export, these are its rows whatever is written meanwhile.
+    """
+    object_ids, isolate_ids = [], []
+    cursor = IsolateSheet.get_motor_collection().find(
+        _profiles_filter(species), {"isolate_id": 1}
+    ).sort("_id", 1)
+    async for doc in cursor:
+        object_ids.append(doc["_id"])
+        isolate_ids.append(doc["isolate_id"])
+    return object_ids, isolate_ids
+
+
+async def iter_profile_chunks(
+    species: str, n_loci: int, object_ids: List[ObjectId], isolate_ids: List[str]
+) -> AsyncIterator[Tuple[List[str], np.ndarray]]:
+    """Yield (isolate IDs, uint32 profile matrix) chunks of at most MATRIX_CHUNK_SIZE rows"""
+    positions = await get_positions(species)
+    collection = IsolateSheet.get_motor_collection()
+    for start in range(0, len(object_ids), MATRIX_CHUNK_SIZE):
+        chunk = object_ids[start:start + MATRIX_CHUNK_SIZE]
+        docs = {
+            doc["_id"]: doc async for doc in collection.find(
+                {"_id": {"$in": chunk}}, {"cgmlst.allele_profile": 1}, batch_size=MATRIX_CHUNK_SIZE
+            )
+        }
+        matrix = np.full((len(chunk), n_loci), MISSING_ALLELE, dtype=PROFILE_DTYPE)
+        for row, object_id in zip(matrix, chunk):
+            doc = docs.get(object_id)
+            if doc is not None:
+                fill_profile_row(row, doc["cgmlst"]["allele_profile"], positions)
+        yield isolate_ids[start:start + len(chunk)], matrix
+
+
+class _Sink(io.RawIOBase):
+    """Unseekable file collecting what is written, drained after each step"""
+
+    def __init__(self):
+        self.parts = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def _npy(array: np.ndarray) -> bytes:
+    out = io.BytesIO()
+    np.lib.format.write_array(out, array, allow_pickle=False)
+    return out.getvalue()
+
+
+async def encode_npz(
+    chunks: AsyncIterator[Tuple[List[str], np.ndarray]],
+    loci: List[str],
+    isolate_ids: List[str],
+) -> AsyncIterator[bytes]:
+    """
+    Uncompressed .npz archive, as written by np.savez: `profiles` is the
+    isolate x locus uint32 matrix, `isolate_ids` and `loci` the string
+    arrays of its row and column labels. Loads with np.load as is.
+    """
+    sink = _Sink()
+    archive = zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED, allowZip64=True)
+    archive.writestr("isolate_ids.npy", _npy(np.array(isolate_ids, dtype=str)))
+    archive.writestr("loci.npy", _npy(np.array(loci, dtype=str)))
+    yield sink.drain()
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {
+        "descr": np.lib.format.dtype_to_descr(np.dtype(PROFILE_DTYPE)),
+        "fortran_order": False,
+        "shape": (len(isolate_ids), len(loci)),
+    })
+    # The size of the member is not known to the archive, it is streamed
+    with archive.open("profiles.npy", "w", force_zip64=True) as member:
+        member.write(header.getvalue())
+        async for _, matrix in chunks:
+            member.write(matrix.tobytes())
+            yield sink.drain()
+    archive.close()
+    yield sink.drain()
+
+
+async def encode_arrow(
+    chunks: AsyncIterator[Tuple[List[str], np.ndarray]],
+    loci: List[str],
+) -> AsyncIterator[bytes]:
+    """Arrow IPC stream, one record batch per chunk and one uint32 column per locus"""
+    schema = pa.schema(
+        [("isolate_id", pa.string())] + [(locus, pa.uint32()) for locus in loci]
+    )
+    sink = io.BytesIO()
+
+    def drain() -> bytes:
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    writer = pa.ipc.new_stream(sink, schema)
+    yield drain()
+    async for ids, matrix in chunks:
+        writer.write_batch(pa.RecordBatch.from_arrays(
+            [pa.array(ids, type=pa.string())] + [pa.array(column) for column in matrix.T],
+            schema=schema,
+        ))
+        yield drain()
+    writer.close()
+    yield drain()
+
+
+async def encode_tsv_gz(
+    chunks: AsyncIterator[Tuple[List[str], np.ndarray]],
+    loci: List[str],
+) -> AsyncIterator[bytes]:
+    """Gzipped chewBBACCA profile table, missing alleles written as 0"""
+    gz = zlib.compressobj(wbits=31)
+
+    def encode(ids: List[str], matrix: np.ndarray) -> bytes:
+        lines = "".join(
+            isolate_id + "\t" + "\t".join(map(str, row)) + "\n"
+            for isolate_id, row in zip(ids, matrix.tolist())
+        )
+        return gz.compress(lines.encode())
+
+    yield gz.compress(("FILE\t" + "\t".join(loci) + "\n").encode())
+    async for ids, matrix in chunks:
+        # Formatting and compressing a chunk takes long enough to hold up other requests
+        yield await run_in_threadpool(encode, ids, matrix)
+    yield gz.flush()
@@ -0,0 +1,71 @@
+from typing import List, Optional
+
+from pymongo import UpdateOne
+
+from server.models.clusters import ClusterSheet, QueryClusterMembership, _Membership, _Subcluster
+
+
+# Clusters updated per round trip when backfilling
+BACKFILL_BATCH_SIZE = 500
+
+
+def flatten_members(
+    root_members: Optional[List[str]], subclusters: Optional[List[_Subcluster]]
+) -> List[_Membership]:
+    """One entry per member and subcluster, root members outside any subcluster get None"""
+    membership = [
+        _Membership(isolate_id=member, subcluster_id=subcluster.subcluster_id)
+        for subcluster in subclusters or []
+        for member in subcluster.members
+    ]
+    in_subclusters = {entry.isolate_id for entry in membership}
+    membership.extend(
+        _Membership(isolate_id=member)
+        for member in dict.fromkeys(root_members or [])
+        if member not in in_subclusters
+    )
+    return membership
+
+
+async def backfill_membership() -> None:
+    """Set the membership of clusters stored before it was maintained"""
+    collection = ClusterSheet.get_motor_collection()
+    cursor = collection.find(
+        {"membership": {"$exists": False}},
+        {"root_members": 1, "subclusters.subcluster_id": 1, "subclusters.members": 1},
+    )
+    updates = []
+    async for doc in cursor:
+        subclusters = [
+            _Subcluster.model_construct(**subcluster) for subcluster in doc.get("subclusters") or []
+        ]
+        membership = flatten_members(doc.get("root_members"), subclusters)
+        updates.append(UpdateOne(
+            {"_id": doc["_id"]},
+            {"$set": {"membership": [entry.model_dump() for entry in membership]}},
+        ))
+        if len(updates) >= BACKFILL_BATCH_SIZE:
+            await collection.bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        await collection.bulk_write(updates, ordered=False)
+
+
+async def find_clusters(isolate_id: str) -> List[QueryClusterMembership]:
+    """Clusters and subclusters of an isolate, from the multikey membership index"""
+    pipeline = [
+        {"$match": {"membership.isolate_id": isolate_id}},
+        {"$project": {
+            "_id": 0,
+            "cluster_id": 1,
+            "membership": {"$filter": {
+                "input": "$membership",
+                "cond": {"$eq": ["$$this.isolate_id", isolate_id]},
+            }},
+        }},
+    ]
+    return [
+        QueryClusterMembership(cluster_id=doc["cluster_id"], subcluster_id=entry.get("subcluster_id"))
+        async for doc in ClusterSheet.get_motor_collection().aggregate(pipeline)
+        for entry in doc["membership"]
+    ]
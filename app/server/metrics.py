@@ -0,0 +1,204 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from pymongo import monitoring
+from starlette.datastructures import MutableHeaders
+from starlette.responses import Response
+
+
+logger = logging.getLogger(__name__)
+
+_SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Time until the response is fully sent",
+    ["method", "route", "status"],
+)
+REQUEST_PHASE = Histogram(
+    "http_request_phase_seconds", "Time spent per request in Mongo commands, serialization and the rest",
+    ["method", "route", "phase"],
+)
+REQUEST_SIZE = Histogram(
+    "http_request_size_bytes", "Request body size", ["method", "route"], buckets=_SIZE_BUCKETS,
+)
+RESPONSE_SIZE = Histogram(
+    "http_response_size_bytes", "Response body size, as sent", ["method", "route"], buckets=_SIZE_BUCKETS,
+)
+MONGO_COMMAND_DURATION = Histogram(
+    "mongo_command_duration_seconds", "Mongo command round trips",
+    ["collection", "command", "outcome"],
+)
+
+
+class RequestTimings:
+    """Time spent by one request in each phase, in seconds"""
+
+    __slots__ = ("db", "serialize", "commands")
+
+    def __init__(self):
+        self.db = 0.0
+        self.serialize = 0.0
+        self.commands = 0
+
+
+# Motor runs the driver in threads with a copy of the context, so the command
+# listener sees the timings of the request that issued the command
+_timings: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+
+@contextmanager
+def timed_serialization():
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.serialize += time.perf_counter() - start
+
+
+class CommandTimer(monitoring.CommandListener):
+    """Records the duration of every Mongo command, per collection and per request"""
+
+    def __init__(self):
+        self._pending: Dict[Tuple, Tuple[str, Optional[RequestTimings]]] = {}
+        self._lock = threading.Lock()
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        collection = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        if not isinstance(collection, str):
+            collection = ""
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = (collection, _timings.get())
+
+    def _finish(self, event, outcome: str) -> None:
+        with self._lock:
+            collection, timings = self._pending.pop((event.connection_id, event.request_id), ("", None))
+        seconds = event.duration_micros / 1e6
+        MONGO_COMMAND_DURATION.labels(collection, event.command_name, outcome).observe(seconds)
+        if timings is not None:
+            timings.db += seconds
+            timings.commands += 1
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._finish(event, "success")
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._finish(event, "failure")
+
+
+def _route(scope) -> str:
+    # Route templates rather than paths keep the label cardinality bounded
+    route = scope.get("route")
+    return getattr(route, "path", "unmatched")
+
+
+def _milliseconds(seconds: float) -> str:
+    return f"{seconds * 1000:.1f}"
+
+
+class MetricsMiddleware:
+    """
+    Request latency and sizes per route, and a `Server-Timing` header with
+    the time spent in Mongo and in serialization until the response starts.
+    Requests slower than `slow_request_seconds` are logged, except under
+    the `slow_request_exempt` path prefixes, which are meant to be held open.
+    """
+
+    def __init__(self, app, slow_request_seconds: Optional[float] = None, slow_request_exempt: Tuple[str, ...] = ()):
+        self.app = app
+        self.slow_request_seconds = slow_request_seconds
+        self.slow_request_exempt = slow_request_exempt
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timings = RequestTimings()
+        token = _timings.set(timings)
+        start = time.perf_counter()
+        received = sent = 0
+        status = 500
+
+        async def counting_receive():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            return message
+
+        async def timing_send(message):
+            nonlocal sent, status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                total = time.perf_counter() - start
+                MutableHeaders(scope=message).append("Server-Timing", ", ".join([
+                    f"db;dur={_milliseconds(timings.db)}",
+                    f"serialize;dur={_milliseconds(timings.serialize)}",
+                    f"total;dur={_milliseconds(total)}",
+                ]))
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, timing_send)
+        finally:
+            _timings.reset(token)
+            total = time.perf_counter() - start
+            method, route = scope["method"], _route(scope)
+            REQUEST_DURATION.labels(method, route, str(status)).observe(total)
+            REQUEST_SIZE.labels(method, route).observe(received)
+            RESPONSE_SIZE.labels(method, route).observe(sent)
+            other = max(total - timings.db - timings.serialize, 0.0)
+            for phase, seconds in (("db", timings.db), ("serialize", timings.serialize), ("other", other)):
+                REQUEST_PHASE.labels(method, route, phase).observe(seconds)
+            slow = self.slow_request_seconds is not None and total >= self.slow_request_seconds
+            if slow and not scope["path"].startswith(self.slow_request_exempt):
+                path = scope["path"] + ("?" + scope["query_string"].decode("latin-1") if scope["query_string"] else "")
+                logger.warning(
+                    "Slow request: %s %s %s in %s ms (db %s ms in %d commands, serialize %s ms, %d bytes sent)",
+                    method, path, status, _milliseconds(total), _milliseconds(timings.db),
+                    timings.commands, _milliseconds(timings.serialize), sent,
+                )
+
+
+def clear_multiprocess_dir() -> None:
+    """
+    Empty PROMETHEUS_MULTIPROC_DIR before the workers start, the files of
+    an earlier run or of other processes would be merged into the counts
+    """
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if not path:
+        return
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        if name.endswith(".db"):
+            os.remove(os.path.join(path, name))
+
+
+def metrics_response() -> Response:
+    """
+    Prometheus exposition of this process, or of every worker when
+    PROMETHEUS_MULTIPROC_DIR is set for a multi-worker server
+    """
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,92 @@
+"""
+One-off migration of the database, run once per deploy before the workers start:
+
+    python -m server.migrate [--dedupe]
+
+Reconciles the collections with the indexes declared on the document models,
+dropping the ones no longer declared. Unique indexes cannot be built over the
+duplicates that older versions let in: they are listed and the migration
+stops, unless `--dedupe` keeps the first stored document of each key and
+deletes the others. Clusters stored before the membership index was
+maintained get theirs.
+"""
+import argparse
+import asyncio
+import logging
+import sys
+from typing import List
+
+from beanie import init_beanie
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+from server import database, fasta, membership
+from server.models.sequences import Sequence
+
+
+logger = logging.getLogger(__name__)
+
+
+def unique_keys(model) -> List[List[str]]:
+    """Fields of each unique index declared on a document model"""
+    return [
+        list(index.document["key"])
+        for index in model.Settings.indexes
+        if index.document.get("unique")
+    ]
+
+
+async def find_duplicates(collection, keys: List[str]) -> List[dict]:
+    """Groups of documents sharing a unique key, with their `_id`s"""
+    return await collection.aggregate([
+        # Field names of the group key cannot hold dots, the values go by position
+        {"$group": {"_id": {str(i): f"${key}" for i, key in enumerate(keys)}, "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}},
+    ], allowDiskUse=True).to_list(None)
+
+
+async def deduplicate(db, dedupe: bool) -> bool:
+    """Whether the unique keys hold, after deleting the duplicates if `dedupe`"""
+    clean = True
+    for model in database.doc_models:
+        collection = db[model.Settings.name]
+        for keys in unique_keys(model):
+            for group in await find_duplicates(collection, keys):
+                kept, *extra = sorted(group["ids"])
+                values = list(group["_id"].values())
+                if not dedupe:
+                    logger.error("%s: %d documents with %s = %s", model.Settings.name, len(extra) + 1, keys, values)
+                    clean = False
+                    continue
+                if model is Sequence:
+                    # The files of the deleted records go with them
+                    bucket = AsyncIOMotorGridFSBucket(db, bucket_name=fasta.BUCKET_NAME)
+                    async for doc in collection.find({"_id": {"$in": extra}, "file_id": {"$ne": None}}, {"file_id": 1}):
+                        await bucket.delete(doc["file_id"])
+                await collection.delete_many({"_id": {"$in": extra}})
+                logger.warning("%s: kept %s of %s = %s, deleted %s", model.Settings.name, kept, keys, values, extra)
+    return clean
+
+
+async def migrate(dedupe: bool = False) -> bool:
+    client = database.connect()
+    try:
+        db = client[database.settings.MONGO_DB]
+        if not await deduplicate(db, dedupe):
+            logger.error("Duplicates block the unique indexes, rerun with --dedupe to keep the first document of each")
+            return False
+        await init_beanie(database=db, document_models=database.doc_models, allow_index_dropping=True)
+        await membership.backfill_membership()
+        return True
+    finally:
+        database.close_db()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconcile the indexes of the Geuebt database")
+    parser.add_argument(
+        "--dedupe", action="store_true",
+        help="Delete all but the first stored document of each duplicated unique key"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    sys.exit(0 if asyncio.run(migrate(args.dedupe)) else 1)
@@ -5,8 +5,17 @@ from enum import Enum
 from typing import Optional, Dict, List
 from typing_extensions import Annotated
 
+import numpy as np
 from beanie import Document
-from pydantic import BaseModel, Field
+from pymongo import ASCENDING, IndexModel
+from pydantic import (
+    BaseModel,
+    Field,
+    WithJsonSchema,
+    field_serializer,
+    field_validator,
+    model_validator,
+)
 
 
 # Special Types Definitions ===============================
@@ -34,6 +43,12 @@ class _Subcluster(BaseModel):
     members: List[str]
 
 
+class _Membership(BaseModel):
+    """Part of ClusterSheet - one member and its subcluster, None for root members"""
+    isolate_id: str
+    subcluster_id: Optional[str] = None
+
+
 class _PublicAnnotation(BaseModel):
     user: str
     date: Optional[datetime.datetime] | None = datetime.datetime.now()
@@ -53,14 +68,92 @@ class _TagInfo(BaseModel):
     date: Optional[datetime.datetime] | None = datetime.datetime.now()
 
 
+class CondensedDistances(BaseModel):
+    """
+    Distance matrix as the ordered members and the upper triangle, column by
+    column: (0,1), (0,2), (1,2), (0,3), ... Exchanged as a flat list of
+    integers, stored as one packed little-endian uint32 binary per member
+    holding its distances to all previous members.
+    """
+    members: List[str]
+    distances: Annotated[
+        List[bytes],
+        WithJsonSchema({"type": "array", "items": {"type": "integer", "minimum": 0}}),
+    ]
+
+    @field_validator("distances", mode="before")
+    @classmethod
+    def pack_distances(cls, value, info):
+        if not isinstance(value, list) or any(isinstance(column, bytes) for column in value):
+            return value
+        n = len(info.data.get("members", []))
+        flat = np.asarray(value, dtype=np.int64)
+        if len(flat) != n * (n - 1) // 2:
+            raise ValueError(f"expected {n * (n - 1) // 2} distances for {n} members, got {len(flat)}")
+        if len(flat) and (flat.min() < 0 or flat.max() > 0xFFFFFFFF):
+            raise ValueError("distances must be non-negative 32 bit integers")
+        packed = flat.astype("<u4")
+        return [packed[j * (j - 1) // 2:j * (j + 1) // 2].tobytes() for j in range(n)]
+
+    @model_validator(mode="after")
+    def check_columns(self):
+        if len(self.distances) != len(self.members) or any(
+            len(column) != 4 * j for j, column in enumerate(self.distances)
+        ):
+            raise ValueError("distances do not match the number of members")
+        return self
+
+    @field_serializer("distances")
+    def unpack_distances(self, distances: List[bytes]) -> List[int]:
+        return self.condensed().tolist()
+
+    def condensed(self) -> np.ndarray:
+        """Flat column by column upper triangle"""
+        return np.frombuffer(b"".join(self.distances), dtype="<u4")
+
+    @classmethod
+    def from_condensed(cls, members: List[str], condensed) -> "CondensedDistances":
+        return cls(members=members, distances=np.asarray(condensed, dtype=np.int64).tolist())
+
+    @classmethod
+    def from_rows(cls, rows: List[Dict[str, int]]) -> "CondensedDistances":
+        """From the dict-per-row form, rows and keys in member order"""
+        members = list(rows[0]) if rows else []
+        if len(rows) != len(members) or any(row.keys() != rows[0].keys() for row in rows):
+            raise ValueError("distance matrix must be square, with the same members in every row")
+        return cls.from_condensed(
+            members,
+            [rows[i][members[j]] for j in range(len(members)) for i in range(j)],
+        )
+
+    def to_rows(self) -> List[Dict[str, int]]:
+        n = len(self.members)
+        square = np.zeros((n, n), dtype=np.int64)
+        # Lower triangle indices in row order are the upper triangle in column order
+        cols, rows = np.tril_indices(n, -1)
+        square[rows, cols] = self.condensed()
+        square[cols, rows] = square[rows, cols]
+        return [dict(zip(self.members, row)) for row in square.tolist()]
+
+    def without(self, removed) -> "CondensedDistances":
+        """Copy without the given members, the remaining columns are sliced"""
+        columns = [np.frombuffer(column, dtype="<u4") for column in self.distances]
+        kept = [j for j, member in enumerate(self.members) if member not in removed]
+        return CondensedDistances.model_construct(
+            members=[self.members[j] for j in kept],
+            distances=[columns[j][kept[:k]].tobytes() for k, j in enumerate(kept)],
+        )
+
+
 # Document Model ==========================================
 
 
 class ClusterSheet(Document):
     """Cluster sheet document specifications"""
     cluster_id: str
-    created_at: Optional[datetime.datetime] | None = datetime.datetime.now()
-    updated_at: Optional[datetime.datetime] | None = datetime.datetime.now()
+    created_at: Optional[datetime.datetime] | None = Field(default_factory=datetime.datetime.now)
+    # Parsed trees are cached by update time, default to the time of the write
+    updated_at: Optional[datetime.datetime] | None = Field(default_factory=datetime.datetime.now)
     cluster_number: Annotated[int, Field(ge=0)]
     organism: _OrganismEnum
     priority: _Priority
@@ -71,12 +164,23 @@ class ClusterSheet(Document):
     AD_threshold: Annotated[int, Field(ge=0)]
     root_members: Optional[List[str]] | None = None
     subclusters: Optional[List[_Subcluster]] | None = None
-    distance_matrix: List[Dict[str, int]]
+    # Stored condensed, the dict-per-row form is accepted and returned by default
+    distance_matrix: CondensedDistances | List[Dict[str, int]]
     tree: str
+    # Flattened members for isolate to cluster lookups, set by the API and not returned
+    membership: Annotated[Optional[List[_Membership]], Field(exclude=True)] = None
+    # Set by the database on every update, unlike updated_at that the client
+    # may send, the version of cached responses. Not returned
+    written_at: Annotated[Optional[datetime.datetime], Field(exclude=True)] = None
     
     class Settings:
         name = "clusters"
         keep_nulls = False
+        indexes = [
+            IndexModel([("cluster_id", ASCENDING)], unique=True),
+            IndexModel([("organism", ASCENDING), ("cluster_number", ASCENDING)]),
+            IndexModel([("membership.isolate_id", ASCENDING)]),
+        ]
     
     class Config:
         json_schema_extra = {
@@ -125,6 +229,68 @@ class ClusterSheet(Document):
         }
 
 
+# Update Models ===========================================
+
+
+class _NewMember(BaseModel):
+    """Part of PatchCluster - a member appended to the distance matrix"""
+    isolate_id: str
+    # Distances to the members already in the matrix, in matrix order,
+    # followed by those to the members appended before this one
+    distances: List[Annotated[int, Field(ge=0, le=0xFFFFFFFF)]]
+
+
+class PatchCluster(BaseModel):
+    """Changes to a stored cluster, fields left out are kept as they are"""
+    updated_at: Optional[datetime.datetime] = None
+    size: Optional[Annotated[int, Field(ge=0)]] = None
+    representative: Optional[str] = None
+    AD_threshold: Optional[Annotated[int, Field(ge=0)]] = None
+    tree: Optional[str] = None
+    add_root_members: List[str] = []
+    # Removed from the root members, every subcluster and the distance matrix
+    remove_members: List[str] = []
+    # Replace the subclusters with the same ID, others are added
+    subclusters: List[_Subcluster] = []
+    remove_subclusters: List[str] = []
+    # Number of distance matrix members the new distances were computed against
+    matrix_size: Optional[Annotated[int, Field(ge=0)]] = None
+    add_to_matrix: List[_NewMember] = []
+
+    @model_validator(mode="after")
+    def check_matrix_size(self):
+        if self.add_to_matrix and self.matrix_size is None:
+            raise ValueError("matrix_size is required to add members to the distance matrix")
+        return self
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "size": 4,
+                "subclusters": [
+                    {
+                        "subcluster_id": "SA-34.1",
+                        "subcluster_number": 1,
+                        "size": 4,
+                        "representative": "2024-5300721",
+                        "AD_threshold": 5,
+                        "members": [
+                            "2024-5300721",
+                            "2024-5300722",
+                            "2024-8600579",
+                            "2024-8600612"
+                        ]
+                    }
+                ],
+                "matrix_size": 3,
+                "add_to_matrix": [
+                    {"isolate_id": "2024-8600612", "distances": [2, 1, 2]}
+                ],
+                "tree": "((2024-5300722:1,2024-8600612:1):0,2024-8600579:0,2024-5300721:0);\n"
+            }
+        }
+
+
 # Query Models ============================================
 
 
@@ -133,3 +299,30 @@ class OnlyID(BaseModel):
 
     class Settings:
         projection = {"cluster_id": 1}
+
+
+class QueryMembers(BaseModel):
+    cluster_id: str
+    organism: _OrganismEnum
+    root_members: Optional[List[str]] | None = None
+    subclusters: Optional[List[_Subcluster]] | None = None
+
+    class Settings:
+        projection = {"cluster_id": 1, "organism": 1, "root_members": 1, "subclusters": 1}
+
+
+class QueryDistanceMatrix(BaseModel):
+    cluster_id: str
+    distance_matrix: CondensedDistances | List[Dict[str, int]]
+
+
+class QueryClusterMembership(BaseModel):
+    cluster_id: str
+    subcluster_id: Optional[str] = None
+
+
+class QueryTree(BaseModel):
+    cluster_id: str
+    subcluster_id: Optional[str] = None
+    tree: str
+    missing: List[str] = []
@@ -1,17 +1,22 @@
 import datetime
 from enum import Enum
-from typing import Optional, List
+from typing import Optional, List, Union
 from typing_extensions import Annotated
 
 from beanie import Document
+from pymongo import ASCENDING, IndexModel
 from pydantic_core import PydanticCustomError
 from pydantic import (
     BaseModel,
     PastDate,
     Field,
+    Strict,
+    field_validator,
     model_validator,
 )
 
+from server import qc
+
 
 # Special Types Definitions ===============================
 
@@ -113,6 +118,22 @@ class _LocusInfo(BaseModel):
     allele_crc32: int
 
 
+class _NewLocusInfo(_LocusInfo):
+    """
+    Allele of an uploaded profile, packed as uint32. Signed 32 bit CRC32
+    values are taken as their unsigned equivalent. 0 marks a missing allele
+    in the packed profile and is rejected, missing loci are left out.
+    """
+    allele_crc32: Annotated[int, Field(ge=-0x80000000, le=0xFFFFFFFF)]
+
+    @field_validator("allele_crc32")
+    @classmethod
+    def check_not_missing(cls, value: int) -> int:
+        if value == 0:
+            raise ValueError("allele_crc32 0 is reserved for missing alleles, leave the locus out")
+        return value & 0xFFFFFFFF
+
+
 class _AlleleStats(BaseModel):
     """Chewbbacca stats"""
     EXC: Annotated[int, Field(ge=0)]
@@ -125,7 +146,17 @@ class _AlleleStats(BaseModel):
 
 
 class _CGMLSTInfo(BaseModel):
-    allele_profile: List[_LocusInfo]
+    allele_profile: List[_NewLocusInfo]
+    allele_stats: _AlleleStats
+
+
+# Packed in locus schema order, or a list in records stored before profiles were packed
+_StoredProfile = Union[Annotated[bytes, Strict()], List[_LocusInfo]]
+
+
+class _StoredCGMLSTInfo(BaseModel):
+    """Stored form of _CGMLSTInfo, read routes expand the packed profile to a list"""
+    allele_profile: _StoredProfile
     allele_stats: _AlleleStats
 
 
@@ -147,115 +178,30 @@ class IsolateSheet(Document):
     sample_info: _SampleInfo
     epidata: _Epidata
     qc_metrics: _QCmetrics
-    cgmlst: Optional[_CGMLSTInfo] | None = None
+    cgmlst: Optional[_StoredCGMLSTInfo] | None = None
+    # Set by the database whenever an allele profile is written
+    profile_updated_at: Optional[datetime.datetime] | None = None
     
     @model_validator(mode='after')
-    def check_coverage(self):
-        depth = self.qc_metrics.seq_depth
-        organism = self.organism
-        min_coverages = {
-            'Listeria monocytogenes': 20,
-            'Salmonella enterica': 30,
-            'Escherichia coli': 40,
-            'Campylobacter spp.': 20,
-        }
-        if depth < min_coverages[organism] or depth > 200:
-            raise PydanticCustomError(
-                "value_error",
-                f"Value error: 'coverage' for '{organism}' must be between "
-                f"'{min_coverages[organism]}' and 200, got {depth}.",
-            )
-        return self
-
-    @model_validator(mode='after')
-    def check_species_specific_assembly_size(self):
-        expect = self.organism
-        assembly = self.qc_metrics.assembly_size
-        qcdict = {
-            'Listeria monocytogenes': [2700000, 3200000],
-            'Salmonella enterica': [4300000, 5200000],
-            'Escherichia coli': [4500000, 5900000],
-            'Campylobacter spp.': [1500000, 1900000],
-        }
-        if assembly < qcdict[expect][0] or assembly > qcdict[expect][1]:
-            raise PydanticCustomError(
-                "value_error",
-                f"Value error: 'assembly_size' for '{expect}' must be between "
-                f"{qcdict[expect][0]} and {qcdict[expect][1]}, got: {assembly}",
-            )
-        return self
-
-    @model_validator(mode='after')
-    def check_species_specific_orthologs_found(self):
-        expect = self.organism
-        ortho = self.qc_metrics.orthologs_found
-        qcdict = {
-            'Listeria monocytogenes': 95,
-            'Salmonella enterica': 95,
-            'Escherichia coli': 95,
-            'Campylobacter spp.': 80,
-        }
-        if ortho < qcdict[expect]:
-            raise PydanticCustomError(
-                "value_error",
-                f"Value error: 'orthologs_found' for '{expect}' must be at least {qcdict[expect]}, got: {ortho}",
-            )
-        return self
-
-    @model_validator(mode='after')
-    def check_species_specific_duplicated_orthologs(self):
-        expect = self.organism
-        dup = self.qc_metrics.duplicated_orthologs
-        qcdict = {
-            'Listeria monocytogenes': 5,
-            'Salmonella enterica': 5,
-            'Escherichia coli': 5,
-            'Campylobacter spp.': 5,
-        }
-        if dup > qcdict[expect]:
-            raise PydanticCustomError(
-                "value_error",
-                f"Value error: 'duplicated_orthologs' for '{expect}' must be at most {qcdict[expect]}, got: {dup}",
-            )
-        return self
-
-    @model_validator(mode='after')
-    def check_species_specific_fraction_majority_genus(self):
-        expect = self.organism
-        frac = self.qc_metrics.fraction_majority_genus
-        qcdict = {
-            'Listeria monocytogenes': 0.9,
-            'Salmonella enterica': 0.9,
-            'Escherichia coli': 0.9,
-            'Campylobacter spp.': 0.9,
-        }
-        if frac < qcdict[expect]:
-            raise PydanticCustomError(
-                "value_error",
-                f"Value error: 'fraction_majority_genus' for '{expect}' must be at least {qcdict[expect]}, got: {frac}",
-            )
-        return self
-
-    @model_validator(mode='after')
-    def check_species_specific_majority_genus(self):
-        expect = self.organism
-        genus = self.qc_metrics.majority_genus
-        qcdict = {
-            'Listeria monocytogenes': ["Listeria"],
-            'Salmonella enterica': ["Salmonella"],
-            'Escherichia coli': ["Escherichia", "Shigella"],
-            'Campylobacter spp.': ["Campylobacter"],
-        }
-        if genus not in qcdict[expect]:
-            raise PydanticCustomError(
-                "value_error",
-                f"Value error: 'majority_genus' for '{expect}' must be in {qcdict[expect]}, got: {genus}",
-            )
+    def check_species_specific_qc(self):
+        """Species thresholds of the QC rule table, reports the first violation"""
+        if not qc.enabled():
+            return self
+        found = qc.violations(self.organism, self.qc_metrics)
+        if found:
+            raise PydanticCustomError("value_error", found[0]["msg"])
         return self
 
     class Settings:
         name = "isolates"
         keep_nulls = False
+        indexes = [
+            IndexModel([("isolate_id", ASCENDING)], unique=True),
+            # Species listings, paginated on _id
+            IndexModel([("organism", ASCENDING), ("_id", ASCENDING)]),
+            # Neighbour index sync
+            IndexModel([("organism", ASCENDING), ("profile_updated_at", ASCENDING)]),
+        ]
     
     class Config:
         json_schema_extra = {
@@ -356,6 +302,11 @@ class AddAlleleProfile(BaseModel):
         }
 
 
+class BulkAlleleProfile(AddAlleleProfile):
+    """One item of a batched allele profile upload"""
+    isolate_id: str
+
+
 # Query Models ============================================
 
 
@@ -366,9 +317,42 @@ class OnlyID(BaseModel):
         projection = {"isolate_id": 1}
 
 
+class QueryOrganism(BaseModel):
+    isolate_id: str
+    organism: _OrganismEnum
+
+    class Settings:
+        projection = {"isolate_id": 1, "organism": 1}
+
+
+class QueryFastaMD5(BaseModel):
+    isolate_id: str
+    fasta_md5: str
+
+    class Settings:
+        projection = {"isolate_id": 1, "fasta_md5": 1}
+
+
 class QueryProfiles(BaseModel):
     isolate_id: str
     profile: List[_LocusInfo]
 
+
+class _Neighbor(BaseModel):
+    isolate_id: str
+    distance: int
+
+
+class QueryNeighbors(BaseModel):
+    isolate_id: str
+    neighbors: List[_Neighbor]
+
+
+class QueryPackedProfile(BaseModel):
+    """Stored profile, expanded by the route"""
+    isolate_id: str
+    organism: _OrganismEnum
+    profile: Optional[_StoredProfile] | None = None
+
     class Settings:
-        projection = {"isolate_id": 1, "profile": "$cgmlst.allele_profile"}
+        projection = {"isolate_id": 1, "organism": 1, "profile": "$cgmlst.allele_profile"}
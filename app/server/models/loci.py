@@ -0,0 +1,40 @@
+import datetime
+from typing import Optional, List
+
+from beanie import Document
+from pymongo import ASCENDING, IndexModel
+
+from server.models.isolates import _OrganismEnum
+
+
+# Document Model ==========================================
+
+
+class LocusSchema(Document):
+    """
+    Ordered cgMLST loci of one species.
+    Packed allele profiles store one value per locus in this order.
+    Loci are only ever appended so that older, shorter profiles stay valid.
+    """
+    organism: _OrganismEnum
+    updated_at: Optional[datetime.datetime] | None = None
+    loci: List[str]
+
+    class Settings:
+        name = "locus_schemas"
+        keep_nulls = False
+        indexes = [
+            IndexModel([("organism", ASCENDING)], unique=True),
+        ]
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "organism": "Listeria monocytogenes",
+                "loci": [
+                    "lmo0001.fasta",
+                    "lmo0002.fasta",
+                    "lmo0003.fasta"
+                ]
+            }
+        }
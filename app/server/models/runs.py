@@ -3,7 +3,8 @@ from enum import Enum
 from typing import Optional, List
 
 from beanie import Document
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from pymongo import ASCENDING, IndexModel
 
 
 # Special Types Definitions ===============================
@@ -20,7 +21,7 @@ class _StatusFlag(str, Enum):
 
 class _RunMetadata(BaseModel):
     name: str
-    date: Optional[datetime.datetime] | None = datetime.datetime.now()
+    date: Optional[datetime.datetime] | None = Field(default_factory=datetime.datetime.now)
     geuebt_version: str
     user: str
 
@@ -42,6 +43,11 @@ class RunReport(Document):
     class Settings:
         name = "runs"
         keep_nulls = False
+        indexes = [
+            IndexModel([("run_metadata.name", ASCENDING)], unique=True),
+            IndexModel([("run_metadata.date", ASCENDING)]),
+            IndexModel([("samples.isolate_id", ASCENDING)]),
+        ]
     
     class Config:
         json_schema_extra = {
@@ -74,3 +80,32 @@ class OnlyID(BaseModel):
 
     class Settings:
         projection = {"run_name": "$run_metadata.name"}
+
+
+class StatusCounts(BaseModel):
+    PASS: int = 0
+    FAIL: int = 0
+    WARN: int = 0
+
+
+class QueryRunSummary(BaseModel):
+    run_name: str
+    date: Optional[datetime.datetime] = None
+    samples: int
+    counts: StatusCounts
+
+
+class QueryRunsSummary(BaseModel):
+    start: Optional[datetime.datetime] = None
+    end: Optional[datetime.datetime] = None
+    runs: int
+    samples: int
+    counts: StatusCounts
+    per_run: List[QueryRunSummary]
+
+
+class QueryIsolateRun(BaseModel):
+    run_name: str
+    date: Optional[datetime.datetime] = None
+    STATUS: _StatusFlag
+    MESSAGES: List[str]
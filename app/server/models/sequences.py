@@ -2,7 +2,9 @@ import datetime
 from enum import Enum
 from typing import Optional
 
-from beanie import Document
+from beanie import Document, PydanticObjectId
+from pydantic import BaseModel
+from pymongo import ASCENDING, IndexModel
 
 
 # Special Types Definitions ===============================
@@ -12,21 +14,69 @@ class _FileTypesEnum(str, Enum):
     fasta = "fasta"
 
 
+# Nested Fields Models ====================================
+
+
+class _AssemblyStats(BaseModel):
+    """Part of Sequence - contig statistics gathered on upload"""
+    contigs: int
+    total_length: int
+    min_length: int
+    max_length: int
+    n50: int
+
+
 # Document Model ==========================================
 
 
 class Sequence(Document):
-    """Sequence file"""
+    """Sequence file metadata, the compressed file itself is stored in GridFS"""
     isolate_id: str
     created_at: Optional[datetime.datetime] | None = datetime.datetime.now()
     updated_at: Optional[datetime.datetime] | None = None
     sequence_type: _FileTypesEnum
-    sequence: str
+    file_id: Optional[PydanticObjectId] = None
+    encoding: Optional[str] = None
+    length: Optional[int] = None
+    stats: Optional[_AssemblyStats] = None
+    # Inline sequence of records created before GridFS storage
+    sequence: Optional[str] = None
     
     class Settings:
         name = "sequences"
         keep_nulls = False
+        indexes = [
+            IndexModel([("isolate_id", ASCENDING)], unique=True),
+        ]
     
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "isolate_id": "2024-12345678-01",
+                "sequence_type": "fasta",
+                "file_id": "6707a1d3c7c81e4d2f4a9b10",
+                "encoding": "gzip",
+                "length": 56,
+                "stats": {
+                    "contigs": 1,
+                    "total_length": 35,
+                    "min_length": 35,
+                    "max_length": 35,
+                    "n50": 35
+                }
+            }
+        }
+
+
+# Input Models ============================================
+
+
+class AddSequence(BaseModel):
+    """Sequence file sent inline as JSON"""
+    isolate_id: str
+    sequence_type: _FileTypesEnum
+    sequence: str
+
     class Config:
         json_schema_extra = {
             "example": {
@@ -35,3 +85,16 @@ class Sequence(Document):
                 "sequence": ">contig0001 len=35\nATCTGTCCGTAGCTGACGTGCAAGAGCTCGATCGA\n"
             }
         }
+
+
+# Query Models ============================================
+
+
+class QuerySequenceInfo(BaseModel):
+    isolate_id: str
+    created_at: Optional[datetime.datetime] = None
+    updated_at: Optional[datetime.datetime] = None
+    sequence_type: _FileTypesEnum
+    encoding: Optional[str] = None
+    length: Optional[int] = None
+    stats: Optional[_AssemblyStats] = None
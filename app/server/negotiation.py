@@ -0,0 +1,141 @@
+from typing import Any, Callable, Coroutine, Optional
+
+import orjson
+from fastapi import HTTPException, Request, Response
+from fastapi.datastructures import DefaultPlaceholder
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.routing import APIRoute
+
+from server.metrics import timed_serialization
+
+try:
+    import msgpack
+except ImportError:  # MessagePack support is optional
+    msgpack = None
+
+
+MSGPACK_TYPE = "application/msgpack"
+MSGPACK_TYPES = (MSGPACK_TYPE, "application/x-msgpack", "application/vnd.msgpack")
+JSON_TYPE = "application/json"
+
+
+def _media_type(value: Optional[str]) -> str:
+    return (value or "").split(";")[0].strip().lower()
+
+
+def is_msgpack(content_type: Optional[str]) -> bool:
+    return _media_type(content_type) in MSGPACK_TYPES
+
+
+def require_msgpack() -> None:
+    if msgpack is None:
+        raise HTTPException(status_code=415, detail="MessagePack support requires msgpack on the server")
+
+
+def wants_msgpack(accept: Optional[str]) -> bool:
+    """Whether the Accept header ranks MessagePack at least as high as JSON, JSON stays the default"""
+    if msgpack is None or not accept:
+        return False
+    msgpack_q = json_q = 0.0
+    for part in accept.split(","):
+        media_type, *params = [item.strip() for item in part.split(";")]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if media_type.lower() in MSGPACK_TYPES:
+            msgpack_q = max(msgpack_q, q)
+        elif media_type.lower() == JSON_TYPE:
+            json_q = max(json_q, q)
+    return msgpack_q > 0 and msgpack_q >= json_q
+
+
+def packb(value: Any) -> bytes:
+    return msgpack.packb(value, use_bin_type=True)
+
+
+def json_to_msgpack(body: bytes) -> bytes:
+    return packb(orjson.loads(body))
+
+
+class MsgpackResponse(Response):
+    """Packs the JSON compatible content of a route, as JSONResponse dumps it"""
+
+    media_type = MSGPACK_TYPE
+
+    def render(self, content: Any) -> bytes:
+        with timed_serialization():
+            return packb(content)
+
+
+def unpackb(body: bytes) -> Any:
+    try:
+        return msgpack.unpackb(body, raw=False, strict_map_key=False)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=msgpack_error(e))
+
+
+def msgpack_error(e: Exception) -> str:
+    return "Malformed request body: invalid MessagePack" + (f" ({e})" if str(e) else "")
+
+
+class MsgpackRoute(APIRoute):
+    """
+    Route that also reads `application/msgpack` bodies and answers with
+    `application/msgpack` when the Accept header prefers it. Bodies decode
+    to the same values as JSON and go through the same validation.
+    Return values are packed directly, the JSON bodies of responses built
+    by the endpoint are converted. Streamed responses and error responses
+    stay in their own format.
+    """
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        handler = super().get_route_handler()
+        decodes_body = self.body_field is not None
+        response_class = self.response_class
+        if isinstance(response_class, DefaultPlaceholder):
+            response_class = response_class.value
+        msgpack_handler = None
+        if msgpack is not None and issubclass(response_class, JSONResponse):
+            # The same handler, packing the encoded return value instead of dumping it as JSON
+            default_class, self.response_class = self.response_class, MsgpackResponse
+            try:
+                msgpack_handler = super().get_route_handler()
+            finally:
+                self.response_class = default_class
+
+        async def route_handler(request: Request) -> Response:
+            if decodes_body and is_msgpack(request.headers.get("content-type")):
+                require_msgpack()
+                body = await request.body()
+                value = unpackb(body)
+                # Handed on as an already parsed JSON body
+                headers = [(k, v) for k, v in request.scope["headers"] if k != b"content-type"]
+                headers.append((b"content-type", JSON_TYPE.encode()))
+                request = Request({**request.scope, "headers": headers}, request.receive)
+                request._body = body
+                request._json = value
+            packs = wants_msgpack(request.headers.get("accept"))
+            if packs and msgpack_handler is not None:
+                response = await msgpack_handler(request)
+            else:
+                response = await handler(request)
+            if isinstance(response, StreamingResponse) or response.media_type not in (JSON_TYPE, MSGPACK_TYPE):
+                return response
+            vary = [item.strip().lower() for item in response.headers.get("vary", "").split(",")]
+            if "accept" not in vary:
+                response.headers.add_vary_header("Accept")
+            if response.media_type == JSON_TYPE and packs:
+                with timed_serialization():
+                    body = json_to_msgpack(response.body)
+                response.body = body
+                response.media_type = MSGPACK_TYPE
+                response.headers["content-type"] = MSGPACK_TYPE
+                response.headers["content-length"] = str(len(body))
+            return response
+
+        return route_handler
@@ -0,0 +1,227 @@
+import asyncio
+import datetime
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from starlette.concurrency import run_in_threadpool
+
+from server.models.isolates import IsolateSheet
+from server.profiles import (
+    MISSING_ALLELE,
+    PROFILE_DTYPE,
+    fill_profile_row,
+    get_loci,
+    get_positions,
+    species_key,
+)
+
+
+# Rows compared per step, keeps the temporary boolean arrays small
+DISTANCE_BLOCK_SIZE = 1024
+# Re-read profiles written this long before the newest one already seen, so
+# that writes committed slightly out of timestamp order are not missed
+SYNC_OVERLAP = datetime.timedelta(seconds=5)
+# Processes used for pairwise cluster distances. Every API worker runs its own
+# pool, the cores are shared between them
+API_WORKERS = int(os.environ.get("API_WORKERS") or os.environ.get("UVICORN_WORKERS") or 1)
+DISTANCE_WORKERS = max(1, (os.cpu_count() or 1) // API_WORKERS)
+# Rows per block of a profile index, the index grows one block at a time
+INDEX_BLOCK_ROWS = 4096
+
+
+def hamming_distances(matrix: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Allele differences between `query` and every row, ignoring missing loci"""
+    distances = np.empty(len(matrix), dtype=np.int64)
+    present = query != MISSING_ALLELE
+    block = min(DISTANCE_BLOCK_SIZE, len(matrix))
+    differ = np.empty((block, matrix.shape[1]), dtype=bool)
+    called = np.empty((block, matrix.shape[1]), dtype=bool)
+    for start in range(0, len(matrix), block):
+        rows = matrix[start:start + block]
+        n = len(rows)
+        np.not_equal(rows, query, out=differ[:n])
+        np.not_equal(rows, MISSING_ALLELE, out=called[:n])
+        differ[:n] &= called[:n]
+        differ[:n] &= present
+        distances[start:start + n] = np.count_nonzero(differ[:n], axis=1)
+    return distances
+
+
+def _block_distances(blocks: List[np.ndarray], n_rows: int, query: np.ndarray) -> np.ndarray:
+    """hamming_distances over the first `n_rows` rows of a list of blocks"""
+    return np.concatenate([
+        hamming_distances(blocks[start // INDEX_BLOCK_ROWS][:n_rows - start], query)
+        for start in range(0, n_rows, INDEX_BLOCK_ROWS)
+    ])
+
+
+def _condensed_columns(matrix: np.ndarray, start: int, stop: int) -> np.ndarray:
+    return np.concatenate(
+        [hamming_distances(matrix[:j], matrix[j]) for j in range(start, stop)]
+    )
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # Spawned rather than forked, the parent runs an event loop and driver threads
+        _pool = ProcessPoolExecutor(
+            max_workers=DISTANCE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pool
+
+
+def shutdown_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
+
+
+async def pairwise_distances(matrix: np.ndarray) -> np.ndarray:
+    """
+    Condensed pairwise allele distances of the matrix rows, column by column:
+    (0,1), (0,2), (1,2), (0,3), ... Computed in the process pool, split into
+    column ranges of similar cost.
+    """
+    n = len(matrix)
+    if n < 2:
+        return np.empty(0, dtype=np.int64)
+    parts = min(DISTANCE_WORKERS, n - 1)
+    # Column j costs j comparisons, cut the cumulative cost into equal parts
+    cost = np.cumsum(np.arange(n))
+    bounds = [1] + [
+        int(np.searchsorted(cost, cost[-1] * k / parts)) for k in range(1, parts)
+    ] + [n]
+    bounds = sorted(set(bounds))
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(*[
+        loop.run_in_executor(get_pool(), _condensed_columns, matrix[:stop], start, stop)
+        for start, stop in zip(bounds, bounds[1:])
+    ])
+    return np.concatenate(results)
+
+
+class ProfileIndex:
+    """
+    Profiles of one species as uint32 rows, one per isolate in locus schema
+    order, in blocks of INDEX_BLOCK_ROWS rows so that growing never copies
+    the loaded rows. Rows are updated in place by the profile upload routes
+    of this process and synced from the database before each query to pick
+    up writes of other workers.
+    Every worker holds its own copy: rows x loci x 4 bytes per species, e.g.
+    600 MB for 50,000 profiles of a 3000 loci scheme, plus at most one partly
+    filled block (49 MB at that width).
+    """
+
+    def __init__(self, organism: str):
+        self.organism = organism
+        self.ids: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.blocks: List[np.ndarray] = []
+        self.n_loci = 0
+        self.synced_at: Optional[datetime.datetime] = None
+        self.loaded = False
+        self.lock = asyncio.Lock()
+
+    def _reserve(self, n_rows: int, n_loci: int) -> None:
+        if n_loci > self.n_loci:
+            # Loci appended to the schema widen the blocks one at a time
+            for i, block in enumerate(self.blocks):
+                wide = np.full((INDEX_BLOCK_ROWS, n_loci), MISSING_ALLELE, dtype=PROFILE_DTYPE)
+                wide[:, :self.n_loci] = block
+                self.blocks[i] = wide
+            self.n_loci = n_loci
+        while len(self.blocks) * INDEX_BLOCK_ROWS < n_rows:
+            self.blocks.append(np.full((INDEX_BLOCK_ROWS, self.n_loci), MISSING_ALLELE, dtype=PROFILE_DTYPE))
+
+    def _row(self, row: int) -> np.ndarray:
+        return self.blocks[row // INDEX_BLOCK_ROWS][row % INDEX_BLOCK_ROWS]
+
+    def upsert(self, isolate_id: str, stored, positions: Dict[str, int], n_loci: int) -> None:
+        """Insert or replace the row of an isolate from its stored profile"""
+        row = self.rows.get(isolate_id)
+        if row is None:
+            row = len(self.ids)
+            self._reserve(row + 1, n_loci)
+            self.ids.append(isolate_id)
+            self.rows[isolate_id] = row
+        else:
+            self._reserve(len(self.ids), n_loci)
+            self._row(row)[:] = MISSING_ALLELE
+        fill_profile_row(self._row(row), stored, positions)
+
+    async def sync(self) -> None:
+        """Load the species on first use, afterwards fetch recently written profiles only"""
+        async with self.lock:
+            query = {"organism": self.organism, "cgmlst.allele_profile": {"$exists": True}}
+            if self.loaded and self.synced_at is not None:
+                query["profile_updated_at"] = {"$gte": self.synced_at - SYNC_OVERLAP}
+            elif self.loaded:
+                query["profile_updated_at"] = {"$exists": True}
+            cursor = IsolateSheet.get_motor_collection().find(
+                query,
+                {"isolate_id": 1, "cgmlst.allele_profile": 1, "profile_updated_at": 1},
+            )
+            positions = None
+            async for doc in cursor:
+                if positions is None:
+                    n_loci = len(await get_loci(self.organism))
+                    positions = await get_positions(self.organism)
+                stored = doc["cgmlst"]["allele_profile"]
+                if isinstance(stored, bytes):
+                    n_loci = max(n_loci, len(stored) // PROFILE_DTYPE.itemsize)
+                self.upsert(doc["isolate_id"], stored, positions, n_loci)
+                updated_at = doc.get("profile_updated_at")
+                if updated_at and (self.synced_at is None or updated_at > self.synced_at):
+                    self.synced_at = updated_at
+            self.loaded = True
+
+    async def nearest(
+        self, isolate_id: str, max_distance: Optional[int], limit: int
+    ) -> Optional[List[Tuple[str, int]]]:
+        """Closest isolates by allele distance, None if the isolate is not indexed"""
+        row = self.rows.get(isolate_id)
+        if row is None:
+            return None
+        # Snapshot, concurrent growth adds or replaces blocks rather than resizing them
+        blocks = list(self.blocks)
+        ids = list(self.ids)
+        distances = await run_in_threadpool(_block_distances, blocks, len(ids), self._row(row).copy())
+        distances[row] = -1
+        candidates = np.flatnonzero(distances >= 0)
+        if max_distance is not None:
+            candidates = candidates[distances[candidates] <= max_distance]
+        if len(candidates) > limit:
+            candidates = candidates[np.argpartition(distances[candidates], limit - 1)[:limit]]
+        candidates = candidates[np.argsort(distances[candidates], kind="stable")]
+        return [(ids[i], int(distances[i])) for i in candidates]
+
+
+_indexes: Dict[str, ProfileIndex] = {}
+
+
+async def get_index(organism: str) -> ProfileIndex:
+    """Profile index of a species, synced with the database"""
+    organism = species_key(organism)
+    if organism not in _indexes:
+        _indexes[organism] = ProfileIndex(organism)
+    index = _indexes[organism]
+    await index.sync()
+    return index
+
+
+def record_profile(organism: str, isolate_id: str, packed: bytes) -> None:
+    """Keep an already loaded index current after a profile write"""
+    index = _indexes.get(species_key(organism))
+    if index is None or not index.loaded:
+        return
+    n_loci = len(packed) // PROFILE_DTYPE.itemsize
+    index.upsert(isolate_id, packed, {}, n_loci)
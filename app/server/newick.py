@@ -0,0 +1,188 @@
+import math
+import re
+from array import array
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+
+# Parsed trees kept in memory, keyed by cluster and last update
+TREE_CACHE_SIZE = 64
+
+_TOKEN = re.compile(r"\s*(?:'((?:[^']|'')*)'|\[[^\]]*\]|([(),:;])|([^\s(),:;\[\]']+))")
+_NEEDS_QUOTES = re.compile(r"[\s(),:;\[\]']")
+
+
+class Tree:
+    """
+    Newick tree as flat arrays in pre-order: parent, first child and next
+    sibling indices (-1 for none), labels and branch lengths (NaN if unset).
+    """
+
+    def __init__(self):
+        self.parent = array("i")
+        self.first_child = array("i")
+        self.next_sibling = array("i")
+        self.last_child = array("i")
+        self.names: List[Optional[str]] = []
+        self.lengths = array("d")
+        self.leaves: Dict[str, int] = {}
+
+    def _add(self, parent: int) -> int:
+        node = len(self.names)
+        self.parent.append(parent)
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+        self.last_child.append(-1)
+        self.names.append(None)
+        self.lengths.append(math.nan)
+        if parent >= 0:
+            if self.first_child[parent] < 0:
+                self.first_child[parent] = node
+            else:
+                self.next_sibling[self.last_child[parent]] = node
+            self.last_child[parent] = node
+        return node
+
+    def children(self, node: int) -> Iterable[int]:
+        child = self.first_child[node]
+        while child >= 0:
+            yield child
+            child = self.next_sibling[child]
+
+    def subtree(self, members: Optional[Set[str]] = None) -> str:
+        """
+        Newick of the tree induced by the given leaves, or of the whole tree.
+        Nodes left with a single child are merged into it, adding up lengths.
+        """
+        n = len(self.names)
+        kept = array("i", [0]) * n
+        for node in range(n - 1, -1, -1):
+            if self.first_child[node] < 0:
+                kept[node] = int(members is None or self.names[node] in members)
+            if kept[node] and node > 0:
+                kept[self.parent[node]] += kept[node]
+        if not n or not kept[0]:
+            return ""
+        out = []
+        # The edges above the new root are dropped along with its ancestors
+        root, _ = self._collapse(0, math.nan, kept)
+        stack: List[Tuple] = [(root, self.lengths[0] if root == 0 else math.nan)]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                out.append(item)
+                continue
+            node, length = item
+            suffix = _label(self.names[node]) + _length(length)
+            kids = [self._collapse(child, self.lengths[child], kept) for child in self.children(node) if kept[child]]
+            if not kids:
+                out.append(suffix)
+                continue
+            stack.append(")" + suffix)
+            for i in range(len(kids) - 1, -1, -1):
+                stack.append(kids[i])
+                if i:
+                    stack.append(",")
+            stack.append("(")
+        return "".join(out) + ";"
+
+    def _collapse(self, node: int, length: float, kept) -> Tuple[int, float]:
+        while self.first_child[node] >= 0:
+            kids = [child for child in self.children(node) if kept[child]]
+            if len(kids) != 1:
+                break
+            node = kids[0]
+            length = _add_lengths(length, self.lengths[node])
+        return node, length
+
+
+def _add_lengths(a: float, b: float) -> float:
+    if math.isnan(a):
+        return b
+    if math.isnan(b):
+        return a
+    return a + b
+
+
+def _label(name: Optional[str]) -> str:
+    if not name:
+        return ""
+    if _NEEDS_QUOTES.search(name):
+        return "'" + name.replace("'", "''") + "'"
+    return name
+
+
+def _length(length: float) -> str:
+    if math.isnan(length):
+        return ""
+    text = repr(length)
+    return ":" + (text[:-2] if text.endswith(".0") else text)
+
+
+def parse(newick: str) -> Tree:
+    """Parse a Newick string, raises ValueError if it is malformed"""
+    tree = Tree()
+    node = tree._add(-1)
+    depth = 0
+    expect_length = False
+    pos = 0
+    for match in _TOKEN.finditer(newick):
+        if match.start() != pos:
+            raise ValueError(f"unexpected character at position {pos}")
+        pos = match.end()
+        quoted, punct, word = match.groups()
+        if expect_length:
+            if word is None:
+                raise ValueError(f"missing branch length at position {match.start()}")
+            try:
+                tree.lengths[node] = float(word)
+            except ValueError:
+                raise ValueError(f"invalid branch length '{word}'")
+            expect_length = False
+        elif punct == "(":
+            node = tree._add(node)
+            depth += 1
+        elif punct == ",":
+            if depth == 0:
+                raise ValueError("',' outside of parentheses")
+            node = tree._add(tree.parent[node])
+        elif punct == ")":
+            if depth == 0:
+                raise ValueError("unbalanced ')'")
+            node = tree.parent[node]
+            depth -= 1
+        elif punct == ":":
+            expect_length = True
+        elif punct == ";":
+            if depth:
+                raise ValueError("unexpected end of tree")
+            if newick[pos:].strip():
+                raise ValueError(f"unexpected character at position {pos}")
+            break
+        elif quoted is not None or word is not None:
+            tree.names[node] = quoted.replace("''", "'") if quoted is not None else word
+    else:
+        if newick[pos:].strip():
+            raise ValueError(f"unexpected character at position {pos}")
+        raise ValueError("missing ';' at the end of the tree")
+    for node, name in enumerate(tree.names):
+        if name is not None and tree.first_child[node] < 0:
+            tree.leaves[name] = node
+    return tree
+
+
+_trees: "OrderedDict[Hashable, Tree]" = OrderedDict()
+
+
+def cached(key: Hashable) -> Optional[Tree]:
+    tree = _trees.get(key)
+    if tree is not None:
+        _trees.move_to_end(key)
+    return tree
+
+
+def store(key: Hashable, tree: Tree) -> None:
+    _trees[key] = tree
+    _trees.move_to_end(key)
+    while len(_trees) > TREE_CACHE_SIZE:
+        _trees.popitem(last=False)
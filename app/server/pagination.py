@@ -0,0 +1,80 @@
+import json
+from typing import AsyncIterator, Optional, Type
+
+from beanie import Document
+from bson import ObjectId
+from bson.errors import InvalidId
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from motor.motor_asyncio import AsyncIOMotorCursor
+from pydantic import BaseModel
+
+
+NDJSON_TYPE = "application/x-ndjson"
+# Documents written to the stream per chunk
+NDJSON_CHUNK_SIZE = 1000
+
+
+def _cursor(
+    document: Type[Document],
+    query: dict,
+    projection: dict,
+    limit: Optional[int],
+    after: Optional[str],
+) -> AsyncIOMotorCursor:
+    if after is not None:
+        try:
+            query = {**query, "_id": {"$gt": ObjectId(after)}}
+        except InvalidId:
+            raise HTTPException(status_code=422, detail=f"Invalid cursor: {after}")
+    cursor = document.get_motor_collection().find(query, projection).sort("_id", 1)
+    if limit:
+        cursor = cursor.limit(limit)
+    return cursor
+
+
+async def _ndjson(cursor: AsyncIOMotorCursor) -> AsyncIterator[str]:
+    lines = []
+    async for doc in cursor:
+        doc.pop("_id", None)
+        lines.append(json.dumps(doc, default=str) + "\n")
+        if len(lines) == NDJSON_CHUNK_SIZE:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+
+async def list_documents(
+    document: Type[Document],
+    query_model: Type[BaseModel],
+    query: dict,
+    request: Request,
+    response: Response,
+    limit: Optional[int] = None,
+    after: Optional[str] = None,
+):
+    """
+    List the projection `query_model` of the documents matching `query`,
+    in `_id` order. With `limit`, the `_id` to pass as `after` for the next
+    page is returned in the `X-Next-Cursor` header and a `Link` header.
+    Requests accepting `application/x-ndjson` are streamed from the cursor
+    one document per line instead.
+    """
+    projection = {**query_model.Settings.projection, "_id": 1}
+    if NDJSON_TYPE in request.headers.get("accept", ""):
+        return StreamingResponse(
+            _ndjson(_cursor(document, query, projection, limit, after)),
+            media_type=NDJSON_TYPE
+        )
+    docs = await _cursor(
+        document, query, projection, limit + 1 if limit else None, after
+    ).to_list(None)
+    if limit and len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = str(docs[-1]["_id"])
+        response.headers["X-Next-Cursor"] = next_cursor
+        response.headers["Link"] = f'<{request.url.include_query_params(after=next_cursor)}>; rel="next"'
+    for doc in docs:
+        del doc["_id"]
+    return docs
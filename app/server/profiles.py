@@ -0,0 +1,149 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+from bson import Binary
+from pymongo import ReturnDocument
+
+from server.models.isolates import IsolateSheet
+from server.models.loci import LocusSchema
+
+
+# Allele profiles are stored as packed little-endian uint32 values, one per
+# locus of the species schema. Loci without a call hold MISSING_ALLELE, as do
+# trailing loci added to the schema after the profile was written.
+PROFILE_DTYPE = np.dtype("<u4")
+MISSING_ALLELE = 0
+
+# Per-process copy of the schemas, refreshed whenever a profile refers to
+# loci it does not know about yet
+_loci: Dict[str, List[str]] = {}
+_positions: Dict[str, Dict[str, int]] = {}
+
+
+def species_key(organism) -> str:
+    """Organism as a plain string, enum members and their values hash differently"""
+    return getattr(organism, "value", organism)
+
+
+def _cache_schema(organism: str, loci: List[str]) -> None:
+    _loci[organism] = loci
+    _positions[organism] = {locus: i for i, locus in enumerate(loci)}
+
+
+async def get_loci(organism: str, min_length: int = 0, refresh: bool = False) -> List[str]:
+    """
+    Locus schema of a species, holding at least `min_length` loci if known.
+    `refresh` reads it again, for loci other workers may have added.
+    """
+    organism = species_key(organism)
+    if refresh or organism not in _loci or len(_loci[organism]) < min_length:
+        doc = await LocusSchema.get_motor_collection().find_one(
+            {"organism": organism}, {"loci": 1}
+        )
+        _cache_schema(organism, doc["loci"] if doc else [])
+    return _loci[organism]
+
+
+async def get_positions(organism: str) -> Dict[str, int]:
+    """Map of locus name to column in the current locus schema of a species"""
+    await get_loci(organism)
+    return _positions[species_key(organism)]
+
+
+async def _get_positions(organism: str, loci: List[str]) -> Dict[str, int]:
+    organism = species_key(organism)
+    await get_loci(organism)
+    positions = _positions[organism]
+    new = [locus for locus in dict.fromkeys(loci) if locus not in positions]
+    if new:
+        # $addToSet keeps the existing order and appends unknown loci in the
+        # order given, so concurrent writers agree on the final schema
+        doc = await LocusSchema.get_motor_collection().find_one_and_update(
+            {"organism": organism},
+            {
+                "$addToSet": {"loci": {"$each": new}},
+                "$currentDate": {"updated_at": True},
+            },
+            projection={"loci": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        _cache_schema(organism, doc["loci"])
+        positions = _positions[organism]
+    return positions
+
+
+async def pack_profile(organism: str, allele_profile: List) -> Binary:
+    """Pack a list of `{locus, allele_crc32}` entries in schema order"""
+    positions = await _get_positions(organism, [entry.locus for entry in allele_profile])
+    values = np.full(len(positions), MISSING_ALLELE, dtype=PROFILE_DTYPE)
+    values[[positions[entry.locus] for entry in allele_profile]] = [
+        entry.allele_crc32 for entry in allele_profile
+    ]
+    return Binary(values.tobytes())
+
+
+def decode_profile(packed: bytes) -> np.ndarray:
+    """Zero-copy, read-only view of a packed profile"""
+    return np.frombuffer(packed, dtype=PROFILE_DTYPE)
+
+
+def fill_profile_row(row: np.ndarray, stored, positions: Dict[str, int]) -> None:
+    """
+    Write a stored profile into a row of a profile matrix. `row` is expected
+    to be initialised with MISSING_ALLELE, loci beyond its length are dropped.
+    """
+    if isinstance(stored, bytes):
+        values = decode_profile(stored)[:len(row)]
+        row[:len(values)] = values
+        return
+    # List shaped profiles of older records, which may hold signed values
+    for entry in stored:
+        i = positions.get(entry["locus"])
+        if i is not None and i < len(row):
+            row[i] = entry["allele_crc32"] & 0xFFFFFFFF
+
+
+async def expand_profile(organism: str, packed: bytes) -> List[dict]:
+    """Unpack a profile to the `{locus, allele_crc32}` list shape of the API"""
+    values = decode_profile(packed)
+    loci = await get_loci(organism, min_length=len(values))
+    return [
+        {"locus": loci[i], "allele_crc32": int(values[i])}
+        for i in np.flatnonzero(values != MISSING_ALLELE)
+    ]
+
+
+async def expand_cgmlst(doc: dict) -> dict:
+    """Expand the packed profile of a raw isolate document in place"""
+    cgmlst = doc.get("cgmlst")
+    if cgmlst and isinstance(cgmlst.get("allele_profile"), bytes):
+        cgmlst["allele_profile"] = await expand_profile(doc["organism"], cgmlst["allele_profile"])
+    return doc
+
+
+async def load_profile_matrix(organism: str, isolate_ids: List[str]) -> Tuple[np.ndarray, List[str]]:
+    """
+    Profiles of the given isolates as a uint32 matrix, one row per ID in the
+    given order. Also returns the IDs without a stored profile, their rows
+    are left missing.
+    """
+    positions = await get_positions(organism)
+    docs = await IsolateSheet.get_motor_collection().find(
+        {
+            "isolate_id": {"$in": isolate_ids},
+            "organism": species_key(organism),
+            "cgmlst.allele_profile": {"$exists": True},
+        },
+        {"isolate_id": 1, "cgmlst.allele_profile": 1},
+    ).to_list(None)
+    n_loci = len(positions)
+    for doc in docs:
+        if isinstance(doc["cgmlst"]["allele_profile"], bytes):
+            n_loci = max(n_loci, len(doc["cgmlst"]["allele_profile"]) // PROFILE_DTYPE.itemsize)
+    rows = {isolate_id: i for i, isolate_id in enumerate(isolate_ids)}
+    matrix = np.full((len(isolate_ids), n_loci), MISSING_ALLELE, dtype=PROFILE_DTYPE)
+    for doc in docs:
+        fill_profile_row(matrix[rows[doc["isolate_id"]]], doc["cgmlst"]["allele_profile"], positions)
+    found = {doc["isolate_id"] for doc in docs}
+    return matrix, [isolate_id for isolate_id in isolate_ids if isolate_id not in found]
@@ -0,0 +1,161 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import Enum
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+from pydantic import BaseModel
+
+
+class _Threshold(BaseModel):
+    """Bounds of one QC metric, any of them may be left out"""
+    min: Optional[float] = None
+    max: Optional[float] = None
+    allowed: Optional[List[str]] = None
+
+
+class QCRuleSet(BaseModel):
+    """
+    Species thresholds as stored in the `qc_rules` collection,
+    each metric given here replaces the default one
+    """
+    organism: str
+    rules: Dict[str, _Threshold]
+
+
+DEFAULT_RULES = {
+    'Listeria monocytogenes': {
+        "seq_depth": {"min": 20, "max": 200},
+        "assembly_size": {"min": 2700000, "max": 3200000},
+        "orthologs_found": {"min": 95},
+        "duplicated_orthologs": {"max": 5},
+        "fraction_majority_genus": {"min": 0.9},
+        "majority_genus": {"allowed": ["Listeria"]},
+    },
+    'Salmonella enterica': {
+        "seq_depth": {"min": 30, "max": 200},
+        "assembly_size": {"min": 4300000, "max": 5200000},
+        "orthologs_found": {"min": 95},
+        "duplicated_orthologs": {"max": 5},
+        "fraction_majority_genus": {"min": 0.9},
+        "majority_genus": {"allowed": ["Salmonella"]},
+    },
+    'Escherichia coli': {
+        "seq_depth": {"min": 40, "max": 200},
+        "assembly_size": {"min": 4500000, "max": 5900000},
+        "orthologs_found": {"min": 95},
+        "duplicated_orthologs": {"max": 5},
+        "fraction_majority_genus": {"min": 0.9},
+        "majority_genus": {"allowed": ["Escherichia", "Shigella"]},
+    },
+    'Campylobacter spp.': {
+        "seq_depth": {"min": 20, "max": 200},
+        "assembly_size": {"min": 1500000, "max": 1900000},
+        "orthologs_found": {"min": 80},
+        "duplicated_orthologs": {"max": 5},
+        "fraction_majority_genus": {"min": 0.9},
+        "majority_genus": {"allowed": ["Campylobacter"]},
+    },
+}
+
+# Names used in messages where they differ from the qc_metrics field
+FIELD_LABELS = {"seq_depth": "coverage"}
+
+Check = Callable[[str, Any], Optional[str]]
+
+
+def _number(value: float):
+    return int(value) if float(value).is_integer() else value
+
+
+def _compile(field: str, threshold: _Threshold) -> Check:
+    """Check function of one metric, returns the message of a violation or None"""
+    label = FIELD_LABELS.get(field, field)
+    low, high = threshold.min, threshold.max
+    if threshold.allowed is not None:
+        allowed = frozenset(threshold.allowed)
+        listed = list(threshold.allowed)
+
+        def check(organism, value):
+            if isinstance(value, str) and value not in allowed:
+                return f"Value error: '{label}' for '{organism}' must be in {listed}, got: {value}"
+        return check
+    if low is not None and high is not None:
+        bounds = f"between {_number(low)} and {_number(high)}"
+    elif low is not None:
+        bounds = f"at least {_number(low)}"
+    else:
+        bounds = f"at most {_number(high)}"
+    low = float("-inf") if low is None else low
+    high = float("inf") if high is None else high
+
+    def check(organism, value):
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            # Wrong types are reported by the model validation
+            return None
+        if not low <= value <= high:
+            return f"Value error: '{label}' for '{organism}' must be {bounds}, got: {value}"
+    return check
+
+
+def compile_rules(rules: Mapping[str, Mapping[str, Any]]) -> Dict[str, Tuple[Tuple[str, Check], ...]]:
+    return {
+        organism: tuple(
+            (field, _compile(field, _Threshold.model_validate(threshold)))
+            for field, threshold in thresholds.items()
+        )
+        for organism, thresholds in rules.items()
+    }
+
+
+_rules = compile_rules(DEFAULT_RULES)
+# Set while validating sheets whose QC is checked separately. A context
+# variable because Document.__init__ drops the pydantic validation context
+_skip = ContextVar("skip_qc", default=False)
+
+
+@contextmanager
+def skipped():
+    token = _skip.set(True)
+    try:
+        yield
+    finally:
+        _skip.reset(token)
+
+
+def enabled() -> bool:
+    return not _skip.get()
+
+
+async def load_rules(database) -> None:
+    """Merge the overrides of the qc_rules collection into the defaults and recompile"""
+    rules = {organism: dict(thresholds) for organism, thresholds in DEFAULT_RULES.items()}
+    async for doc in database["qc_rules"].find({}, {"_id": 0}):
+        rule_set = QCRuleSet.model_validate(doc)
+        rules.setdefault(rule_set.organism, {}).update(
+            {field: threshold.model_dump() for field, threshold in rule_set.rules.items()}
+        )
+    global _rules
+    _rules = compile_rules(rules)
+
+
+def violations(organism, qc_metrics) -> List[dict]:
+    """
+    Every QC rule of the species broken by the metrics, given as a model
+    or as a plain dict. Unknown species have no rules.
+    """
+    if isinstance(organism, Enum):
+        organism = organism.value
+    if not isinstance(organism, str):
+        return []
+    if isinstance(qc_metrics, BaseModel):
+        qc_metrics = vars(qc_metrics)
+    if not isinstance(qc_metrics, Mapping):
+        return []
+    found = []
+    for field, check in _rules.get(organism, ()):
+        if field not in qc_metrics:
+            continue
+        message = check(organism, qc_metrics[field])
+        if message is not None:
+            found.append({"field": f"qc_metrics.{field}", "msg": message})
+    return found
@@ -0,0 +1,59 @@
+import datetime
+
+import numpy as np
+import orjson
+from bson import Decimal128, ObjectId
+
+from server.metrics import timed_serialization
+from server.models.clusters import CondensedDistances
+from server.negotiation import msgpack
+
+
+def _default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        return float(value.to_decimal())
+    if isinstance(value, bytes):
+        return np.frombuffer(value, dtype="<u4").tolist()
+    raise TypeError
+
+
+def _msgpack_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        # As orjson writes them
+        return value.isoformat()
+    return _default(value)
+
+
+def dumps(doc: dict) -> bytes:
+    """
+    Stored document as JSON, without building or validating a model.
+    Fields missing from the document are left out rather than filled with defaults.
+    """
+    with timed_serialization():
+        return orjson.dumps(doc, default=_default)
+
+
+def packb(doc: dict) -> bytes:
+    """Stored document as MessagePack, with the values `dumps` writes"""
+    with timed_serialization():
+        return msgpack.packb(doc, default=_msgpack_default, use_bin_type=True)
+
+
+def cluster(doc: dict, matrix_format: str) -> dict:
+    """Raw cluster document with its distance matrix in the requested form"""
+    doc.pop("membership", None)
+    doc.pop("written_at", None)
+    distance_matrix = doc.get("distance_matrix")
+    if isinstance(distance_matrix, dict):
+        # Stored condensed matrices were validated on write
+        condensed = CondensedDistances.model_construct(**distance_matrix)
+        doc["distance_matrix"] = condensed.to_rows() if matrix_format == "dict" else condensed.model_dump()
+    elif isinstance(distance_matrix, list) and matrix_format == "condensed":
+        doc["distance_matrix"] = CondensedDistances.from_rows(distance_matrix).model_dump()
+    return doc
+
+
+def dumps_cluster(doc: dict, matrix_format: str) -> bytes:
+    return dumps(cluster(doc, matrix_format))
@@ -1,19 +1,68 @@
-from typing import List
+import datetime
+from typing import List, Literal, Optional
+from typing_extensions import Annotated
 
-from fastapi import APIRouter, HTTPException
-from beanie.operators import Set
+import numpy as np
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from beanie.operators import CurrentDate, Set
+from pymongo.results import UpdateResult
+from starlette.concurrency import run_in_threadpool
 
-from server.models.clusters import ClusterSheet, OnlyID
+from server import events, fieldsets, newick, rawjson
+from server.cache import cached_response, stored_version
+from server.models.clusters import (
+    ClusterSheet,
+    CondensedDistances,
+    OnlyID,
+    PatchCluster,
+    QueryMembers,
+    QueryDistanceMatrix,
+    QueryTree,
+)
+from server.membership import flatten_members
+from server.negotiation import JSON_TYPE, MSGPACK_TYPE, MsgpackRoute, wants_msgpack
+from server.neighbors import pairwise_distances
+from server.pagination import list_documents
+from server.profiles import load_profile_matrix
 
 
-router = APIRouter()
+router = APIRouter(route_class=MsgpackRoute)
+
+MatrixFormat = Literal["dict", "condensed"]
+
+
+def _format_matrix(doc, matrix_format: MatrixFormat):
+    """Convert the distance matrix of a cluster or query model to the requested form"""
+    distance_matrix = getattr(doc, "distance_matrix", None)
+    if matrix_format == "dict" and isinstance(distance_matrix, CondensedDistances):
+        doc.distance_matrix = distance_matrix.to_rows()
+    elif matrix_format == "condensed" and isinstance(distance_matrix, list):
+        doc.distance_matrix = CondensedDistances.from_rows(distance_matrix)
+    return doc
 
 
 @router.put("/{cluster_id}", response_description="Create or Update cluster record")
 async def upsert_cluster(cluster_id: str, cluster: ClusterSheet) -> dict:
     # Likely almost all fields change on every update so upsert whole document
     # For update, ignore created_at field
-    await ClusterSheet.find_one(
+    try:
+        _format_matrix(cluster, "condensed")
+    except ValueError as e:
+        body = [{
+            "type": "value_error",
+            "loc": [
+                "body",
+                "distance_matrix"
+            ],
+            "msg": str(e),
+            "input": None,
+            "ctx": {
+                "expected": ""
+            }
+        }]
+        raise HTTPException(status_code=422, detail=body)
+    cluster.membership = flatten_members(cluster.root_members, cluster.subclusters)
+    result = await ClusterSheet.find_one(
         ClusterSheet.cluster_id == cluster_id
     ).upsert(
         Set(
@@ -24,47 +73,326 @@ async def upsert_cluster(cluster_id: str, cluster: ClusterSheet) -> dict:
                 ClusterSheet.subclusters: cluster.subclusters,
                 ClusterSheet.distance_matrix: cluster.distance_matrix,
                 ClusterSheet.tree: cluster.tree,
+                ClusterSheet.membership: cluster.membership,
             }
-        ), 
+        ),
+        CurrentDate({ClusterSheet.written_at: True}),
         on_insert = cluster
     )
+    # The upsert returns the inserted document, or the result of the update
+    await events.publish("cluster", "update" if isinstance(result, UpdateResult) else "insert", cluster_id)
     return {"message": "Cluster added succesfully"}
 
 
-@router.get("/", response_description="List clusters in collection")
-async def get_cluster_ids(species = None) -> List[OnlyID]:
-    if species:
-        docs = await ClusterSheet.find(
-            ClusterSheet.organism == species,
-            ClusterSheet.cluster_number > 0
-        ).project(
-            OnlyID
-        ).to_list()
-    else:
-        docs = await ClusterSheet.find(
-            ClusterSheet.cluster_number > 0
-        ).project(
-            OnlyID
-        ).to_list()
-    return docs
+# Cluster membership recomputed from the updated members, as flatten_members does
+_MEMBERSHIP = {"$let": {
+    "vars": {"subclusters": {"$ifNull": ["$subclusters", []]}},
+    "in": {"$concatArrays": [
+        {"$reduce": {
+            "input": "$$subclusters",
+            "initialValue": [],
+            "in": {"$concatArrays": ["$$value", {"$map": {
+                "input": "$$this.members",
+                "as": "member",
+                "in": {"isolate_id": "$$member", "subcluster_id": "$$this.subcluster_id"},
+            }}]},
+        }},
+        {"$map": {
+            "input": {"$filter": {
+                "input": {"$ifNull": ["$root_members", []]},
+                "as": "member",
+                "cond": {"$not": {"$in": ["$$member", {"$reduce": {
+                    "input": "$$subclusters.members",
+                    "initialValue": [],
+                    "in": {"$concatArrays": ["$$value", "$$this"]},
+                }}]}},
+            }},
+            "as": "member",
+            "in": {"isolate_id": "$$member", "subcluster_id": None},
+        }},
+    ]},
+}}
 
 
-@router.get("/{cluster_id}", response_description="Get cluster by ID")
-async def get_cluster(cluster_id: str) -> ClusterSheet:
+def _without(array: str, removed: List[str], var: str = "kept") -> dict:
+    # Client values are wrapped in $literal, an ID starting with $ is not a field path
+    return {"$filter": {
+        "input": {"$ifNull": [array, []]},
+        "as": var,
+        "cond": {"$not": {"$in": [f"$${var}", {"$literal": removed}]}},
+    }}
+
+
+def _subclusters_update(patch: PatchCluster) -> dict:
+    """Subclusters with removals and replacements applied, new ones appended"""
+    replacements = {subcluster.subcluster_id: subcluster.model_dump() for subcluster in patch.subclusters}
+    kept = {"$filter": {
+        "input": {"$ifNull": ["$subclusters", []]},
+        "as": "subcluster",
+        "cond": {"$not": {"$in": ["$$subcluster.subcluster_id", {"$literal": patch.remove_subclusters}]}},
+    }}
+    updated = "$$subcluster"
+    if patch.remove_members:
+        members = _without("$$subcluster.members", patch.remove_members)
+        updated = {"$mergeObjects": ["$$subcluster", {"members": members, "size": {"$size": members}}]}
+    if replacements:
+        updated = {"$switch": {
+            "branches": [
+                {"case": {"$eq": ["$$subcluster.subcluster_id", {"$literal": subcluster_id}]}, "then": {"$literal": subcluster}}
+                for subcluster_id, subcluster in replacements.items()
+            ],
+            "default": updated,
+        }}
+    added = {"$filter": {
+        "input": {"$literal": list(replacements.values())},
+        "as": "subcluster",
+        "cond": {"$not": {"$in": [
+            "$$subcluster.subcluster_id", {"$ifNull": ["$subclusters.subcluster_id", []]}
+        ]}},
+    }}
+    return {"$concatArrays": [{"$map": {"input": kept, "as": "subcluster", "in": updated}}, added]}
+
+
+async def _patch_conflict(cluster_id: str, detail: str) -> HTTPException:
+    if not await ClusterSheet.find(ClusterSheet.cluster_id == cluster_id).count():
+        return HTTPException(status_code=404, detail="Item not found")
+    return HTTPException(status_code=409, detail=detail)
+
+
+@router.patch("/{cluster_id}", response_description="Apply changes to a cluster record")
+async def patch_cluster(cluster_id: str, patch: PatchCluster) -> dict:
+    """
+    Applies member, subcluster and distance matrix changes in a single
+    update, sending only what changes. New members are appended to the
+    distance matrix as one column each, `matrix_size` must match the stored
+    matrix or the request fails with 409. Removing matrix members rewrites
+    the matrix.
+    """
+    collection = ClusterSheet.get_motor_collection()
+    query = {"cluster_id": cluster_id}
+    changes = {"updated_at": {"$literal": patch.updated_at or datetime.datetime.now()}, "written_at": "$$NOW"}
+    for field in ("size", "representative", "AD_threshold", "tree"):
+        value = getattr(patch, field)
+        if value is not None:
+            changes[field] = {"$literal": value}
+    # Distance matrix: columns of the new members, or the whole matrix after removals
+    base = patch.matrix_size
+    matrix = None
+    if patch.remove_members:
+        doc = await collection.find_one(
+            query, {"distance_matrix.members": 1, "distance_matrix.distances": 1, "written_at": 1}
+        )
+        if doc is None:
+            raise HTTPException(status_code=404, detail="Item not found")
+        stored = doc.get("distance_matrix")
+        if not isinstance(stored, dict):
+            raise HTTPException(status_code=409, detail="Distance matrix is stored row by row, PUT the cluster once to convert it")
+        if patch.matrix_size is not None and patch.matrix_size != len(stored["members"]):
+            raise HTTPException(status_code=409, detail=f"Distance matrix has {len(stored['members'])} members, expected {patch.matrix_size}")
+        removed = set(patch.remove_members)
+        if removed.intersection(stored["members"]):
+            matrix = CondensedDistances.model_construct(**stored).without(removed)
+            base = len(matrix.members)
+            # Any write since the read changes written_at, the matrix is rewritten from what was read
+            query["written_at"] = doc.get("written_at")
+    for i, member in enumerate(patch.add_to_matrix):
+        if len(member.distances) != base + i:
+            raise HTTPException(
+                status_code=422,
+                detail=f"Expected {base + i} distances for '{member.isolate_id}', got {len(member.distances)}",
+            )
+    new_ids = [member.isolate_id for member in patch.add_to_matrix]
+    columns = [np.asarray(member.distances, dtype="<u4").tobytes() for member in patch.add_to_matrix]
+    if matrix is not None:
+        if set(new_ids).intersection(matrix.members):
+            raise HTTPException(status_code=409, detail="Distance matrix already contains an added member")
+        changes["distance_matrix"] = {"$literal": {
+            "members": matrix.members + new_ids,
+            "distances": matrix.distances + columns,
+        }}
+    elif patch.add_to_matrix:
+        query["distance_matrix.members"] = {"$size": patch.matrix_size, "$nin": new_ids}
+        changes["distance_matrix.members"] = {"$concatArrays": ["$distance_matrix.members", {"$literal": new_ids}]}
+        changes["distance_matrix.distances"] = {"$concatArrays": ["$distance_matrix.distances", {"$literal": columns}]}
+    # Members and subclusters, then the membership index derived from them
+    if patch.add_root_members or patch.remove_members:
+        root_members = _without("$root_members", patch.remove_members)
+        changes["root_members"] = {"$concatArrays": [root_members, {"$filter": {
+            "input": {"$literal": list(dict.fromkeys(patch.add_root_members))},
+            "as": "member",
+            "cond": {"$not": {"$in": ["$$member", root_members]}},
+        }}]}
+    if patch.subclusters or patch.remove_subclusters or patch.remove_members:
+        changes["subclusters"] = _subclusters_update(patch)
+    pipeline = [{"$set": changes}]
+    if "root_members" in changes or "subclusters" in changes:
+        pipeline.append({"$set": {"membership": _MEMBERSHIP}})
+    result = await collection.update_one(query, pipeline)
+    if not result.matched_count:
+        raise await _patch_conflict(
+            cluster_id,
+            "Distance matrix changed since it was read, or does not have "
+            f"{patch.matrix_size} members, or already contains an added member",
+        )
+    await events.publish("cluster", "update", cluster_id)
+    return {"message": "Cluster updated succesfully", "matrix_size": base + len(new_ids) if base is not None else None}
+
+
+@router.post("/{cluster_id}/distance_matrix", response_description="Compute and store the distance matrix of a cluster")
+async def compute_distance_matrix(
+    cluster_id: str, matrix_format: MatrixFormat = "dict"
+) -> QueryDistanceMatrix:
+    """
+    Pairwise allele distances between the root and subcluster members,
+    computed from the stored isolate profiles. Loci missing in either
+    profile are ignored.
+    """
     doc = await ClusterSheet.find(
         ClusterSheet.cluster_id == cluster_id
+    ).project(
+        QueryMembers
     ).first_or_none()
     if not doc:
         raise HTTPException(status_code=404, detail="Item not found")
-    return doc
+    members = list(dict.fromkeys(
+        (doc.root_members or [])
+        + [member for subcluster in doc.subclusters or [] for member in subcluster.members]
+    ))
+    profiles, missing = await load_profile_matrix(doc.organism, members)
+    if missing:
+        raise HTTPException(status_code=422, detail=f"No allele profile for members: {', '.join(missing)}")
+    distance_matrix = CondensedDistances.from_condensed(members, await pairwise_distances(profiles))
+    await ClusterSheet.find_one(
+        ClusterSheet.cluster_id == cluster_id
+    ).update(
+        Set(
+            {
+                ClusterSheet.updated_at: datetime.datetime.now(),
+                ClusterSheet.distance_matrix: distance_matrix,
+            }
+        ),
+        CurrentDate({ClusterSheet.written_at: True}),
+    )
+    await events.publish("cluster", "update", cluster_id)
+    return _format_matrix(
+        QueryDistanceMatrix(cluster_id=cluster_id, distance_matrix=distance_matrix),
+        matrix_format
+    )
+
+
+@router.get("/", response_description="List clusters in collection")
+async def get_cluster_ids(
+    request: Request,
+    response: Response,
+    species = None,
+    limit: Annotated[Optional[int], Query(ge=1)] = None,
+    after: Optional[str] = None,
+) -> List[OnlyID]:
+    """Paginate with `limit` and `after`, or stream with `Accept: application/x-ndjson`"""
+    query = {"cluster_number": {"$gt": 0}}
+    if species:
+        query["organism"] = species
+    return await list_documents(ClusterSheet, OnlyID, query, request, response, limit, after)
+
+
+@router.get("/{cluster_id}", response_description="Get cluster by ID")
+async def get_cluster(
+    cluster_id: str,
+    request: Request,
+    matrix_format: MatrixFormat = "dict",
+    fields: Annotated[Optional[str], Query(description="Comma separated fields to return, dot notation for subfields")] = None,
+    exclude: Annotated[Optional[str], Query(description="Comma separated fields to leave out, e.g. `distance_matrix,tree`")] = None,
+    raw: Annotated[bool, Query(description="Return the stored document as is, without model validation")] = False,
+) -> ClusterSheet:
+    """
+    `matrix_format=condensed` returns the distance matrix as the ordered
+    members and the flat column by column upper triangle.
+    Returns only the requested fields with `fields` or `exclude`, the other
+    fields are not read from the database.
+    `raw=true` skips model construction and returns the document as stored:
+    fields missing from it are left out instead of being filled with
+    defaults.
+    Supports conditional requests with `If-None-Match`.
+    """
+    projection, model = fieldsets.projection(ClusterSheet, fields, exclude)
+    if projection is None or 1 not in projection.values():
+        # The membership index and the version are not part of the response
+        projection = {**(projection or {}), "membership": 0, "written_at": 0}
+
+    async def load():
+        doc = await ClusterSheet.get_motor_collection().find_one({"cluster_id": cluster_id}, projection)
+        if not doc:
+            raise HTTPException(status_code=404, detail="Item not found")
+        if raw:
+            return rawjson.cluster(doc, matrix_format)
+        return _format_matrix(model.model_validate(doc), matrix_format)
+
+    def version():
+        return stored_version(ClusterSheet.get_motor_collection(), {"cluster_id": cluster_id}, ("written_at",))
+
+    return await cached_response(
+        request, "cluster", cluster_id, version, load, (matrix_format, fields, exclude, raw)
+    )
+
+
+@router.get("/{cluster_id}/tree", response_description="Get the tree of a cluster or of one subcluster")
+async def get_tree(cluster_id: str, subcluster: Optional[str] = None) -> QueryTree:
+    """
+    With `subcluster`, returns the tree pruned to the members of that
+    subcluster; inner nodes left with a single child are merged into it.
+    Members absent from the tree are listed in `missing`.
+    """
+    collection = ClusterSheet.get_motor_collection()
+    projection = {"_id": 0, "updated_at": 1}
+    if subcluster is not None:
+        projection["subclusters"] = {"$elemMatch": {"subcluster_id": subcluster}}
+    doc = await collection.find_one({"cluster_id": cluster_id}, projection)
+    if not doc:
+        raise HTTPException(status_code=404, detail="Item not found")
+    members = None
+    if subcluster is not None:
+        if not doc.get("subclusters"):
+            raise HTTPException(status_code=404, detail=f"Subcluster not found: {subcluster}")
+        members = set(doc["subclusters"][0].get("members") or ())
+
+    tree = newick.cached((cluster_id, doc.get("updated_at")))
+    if tree is None:
+        # Read again with the tree, the cluster may have changed in between
+        doc = await collection.find_one({"cluster_id": cluster_id}, {"_id": 0, "updated_at": 1, "tree": 1})
+        if not doc or not doc.get("tree"):
+            raise HTTPException(status_code=404, detail="Cluster has no tree")
+        try:
+            tree = await run_in_threadpool(newick.parse, doc["tree"])
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=f"Stored tree is not valid Newick: {e}")
+        newick.store((cluster_id, doc.get("updated_at")), tree)
+
+    if members is None:
+        return QueryTree(cluster_id=cluster_id, tree=tree.subtree())
+    missing = sorted(members.difference(tree.leaves))
+    if len(missing) == len(members):
+        raise HTTPException(status_code=404, detail=f"No member of subcluster {subcluster} is in the tree")
+    return QueryTree(
+        cluster_id=cluster_id, subcluster_id=subcluster, tree=tree.subtree(members), missing=missing
+    )
 
 
 @router.get("/{species}/orphans", response_description="Get orphan cluster for species")
-async def get_orphans(species: str) -> ClusterSheet:
-    doc = await ClusterSheet.find(
-        ClusterSheet.organism == species,
-        ClusterSheet.cluster_number == 0
-    ).first_or_none()
+async def get_orphans(
+    species: str,
+    request: Request,
+    matrix_format: MatrixFormat = "dict",
+    raw: Annotated[bool, Query(description="Return the stored document as is, without model validation")] = False,
+) -> ClusterSheet:
+    # Orphan clusters are large, skip the membership index they also hold
+    doc = await ClusterSheet.get_motor_collection().find_one(
+        {"organism": species, "cluster_number": 0}, {"membership": 0, "written_at": 0}
+    )
     if not doc:
         raise HTTPException(status_code=404, detail="Item not found")
-    return doc
\ No newline at end of file
+    if raw:
+        doc = rawjson.cluster(doc, matrix_format)
+        if wants_msgpack(request.headers.get("accept")):
+            return Response(rawjson.packb(doc), media_type=MSGPACK_TYPE)
+        return Response(rawjson.dumps(doc), media_type=JSON_TYPE)
+    return _format_matrix(ClusterSheet.model_validate(doc), matrix_format)
@@ -0,0 +1,102 @@
+import time
+from typing import Optional, Tuple
+from typing_extensions import Annotated
+
+import orjson
+from fastapi import APIRouter, Header, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+
+from server import events
+from server.negotiation import MsgpackRoute
+
+
+router = APIRouter(route_class=MsgpackRoute)
+
+EVENT_STREAM_TYPE = "text/event-stream"
+# Comment sent on an idle stream so that proxies keep it open
+HEARTBEAT_SECONDS = 15.0
+# Reconnection delay advertised to EventSource clients
+RETRY_MILLISECONDS = 3000
+
+
+def _kinds(kinds: Optional[str]) -> Tuple[str, ...]:
+    if not kinds:
+        return events.KINDS
+    selected = tuple(kind.strip() for kind in kinds.split(",") if kind.strip())
+    unknown = [kind for kind in selected if kind not in events.KINDS]
+    if unknown:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Unknown event kinds: {', '.join(unknown)}, choose from {', '.join(events.KINDS)}",
+        )
+    return selected
+
+
+def _server_sent(event: dict) -> bytes:
+    return b"id: %s\nevent: %s\ndata: %s\n\n" % (
+        event["id"].encode(), event["kind"].encode(), orjson.dumps(event)
+    )
+
+
+async def _event_stream(since: Optional[str], kinds: Tuple[str, ...], limit: int) -> StreamingResponse:
+    updates = events.feed.subscribe(since, kinds, limit)
+    # An expired position is a 410 before the stream starts
+    batch, _ = await anext(updates)
+
+    async def stream():
+        nonlocal batch
+        try:
+            yield b"retry: %d\n\n" % RETRY_MILLISECONDS
+            idle_since = time.monotonic()
+            while True:
+                if batch:
+                    yield b"".join(_server_sent(event) for event in batch)
+                    idle_since = time.monotonic()
+                elif time.monotonic() - idle_since >= HEARTBEAT_SECONDS:
+                    yield b": keep-alive\n\n"
+                    idle_since = time.monotonic()
+                batch, _ = await anext(updates)
+        finally:
+            await updates.aclose()
+
+    return StreamingResponse(
+        stream(),
+        media_type=EVENT_STREAM_TYPE,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get(
+    "",
+    response_description="Insert and update events of isolates, profiles, clusters, sequences and runs",
+    responses={200: {"content": {EVENT_STREAM_TYPE: {}}}},
+)
+async def get_events(
+    request: Request,
+    since: Annotated[Optional[str], Query(description="Position to resume from, the `last_id` of the previous poll or the `id` of an event")] = None,
+    kinds: Annotated[Optional[str], Query(description=f"Comma separated kinds of events, from {', '.join(events.KINDS)}")] = None,
+    timeout: Annotated[float, Query(ge=0, le=60, description="Seconds a poll waits for an event")] = 25.0,
+    limit: Annotated[int, Query(ge=1, le=1000)] = 100,
+    last_event_id: Optional[str] = Header(default=None),
+):
+    """
+    With `Accept: text/event-stream`, a Server-Sent Events stream, one event
+    per insert or update named after its kind, from `since`, the
+    `Last-Event-ID` of a reconnecting client or now.
+    Otherwise a long poll: the events after `since`, waiting up to `timeout`
+    seconds for one, and the `last_id` to poll from next. Without `since`,
+    returns the current position at once.
+    An expired position is answered with 410, resync and start from now.
+    """
+    selected = _kinds(kinds)
+    if EVENT_STREAM_TYPE in request.headers.get("accept", ""):
+        return await _event_stream(last_event_id or since, selected, limit)
+    updates = events.feed.subscribe(since, selected, limit)
+    deadline = time.monotonic() + timeout
+    try:
+        async for batch, last_id in updates:
+            if batch or since is None or time.monotonic() >= deadline:
+                break
+    finally:
+        await updates.aclose()
+    return {"events": batch, "last_id": last_id}
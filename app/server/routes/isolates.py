@@ -1,17 +1,49 @@
-from typing import List
+from typing import List, Optional, Tuple
+from typing_extensions import Annotated
 
-from fastapi import APIRouter, HTTPException
-from beanie.operators import Set
+from fastapi import APIRouter, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from beanie.operators import In
+from pydantic import ValidationError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
-from server.models.isolates import IsolateSheet, AddAlleleProfile, QueryProfiles, OnlyID
+from server.models.clusters import QueryClusterMembership
+from server.models.runs import QueryIsolateRun
+from server.models.isolates import (
+    IsolateSheet,
+    AddAlleleProfile,
+    BulkAlleleProfile,
+    QueryOrganism,
+    QueryNeighbors,
+    QueryProfiles,
+    QueryPackedProfile,
+    OnlyID,
+    _OrganismEnum,
+)
+from server import events, fieldsets, matrix, neighbors, qc
+from server.cache import cached_response, stored_version
+from server.membership import find_clusters
+from server.negotiation import MsgpackRoute
+from server.pagination import list_documents
+from server.profiles import expand_cgmlst, expand_profile, get_loci, pack_profile
+from server.run_stats import isolate_runs
+from server.streaming import iter_json_documents
 
 
-router = APIRouter()
+router = APIRouter(route_class=MsgpackRoute)
+
+# Number of isolate sheets checked and inserted per database round trip
+BULK_BATCH_SIZE = 500
+# Profiles are large (~1700 loci each), keep fewer of them in memory at once
+PROFILE_BATCH_SIZE = 100
 
 
 @router.post("/", response_description="Create isolate record with Metadata")
 async def create_isolate(metadata: IsolateSheet) -> dict:
-    if await IsolateSheet.find(IsolateSheet.isolate_id == metadata.isolate_id).first_or_none():
+    try:
+        await metadata.create()
+    except DuplicateKeyError:
         body = [{
             "type": "str",
             "loc": [
@@ -25,47 +57,327 @@ async def create_isolate(metadata: IsolateSheet) -> dict:
             }
         }]
         raise HTTPException(status_code=422, detail=body)
-    await metadata.create()
+    await events.publish("isolate", "insert", metadata.isolate_id)
     return {"message": "Metadata added succesfully"}
 
 
+@router.post("/bulk", response_description="Create many isolate records from a JSON array or NDJSON stream")
+async def create_isolates_bulk(request: Request) -> dict:
+    """
+    Accepts a JSON array or an NDJSON body (`Content-Type: application/x-ndjson`)
+    of isolate sheets. Items are validated as they are read and written in
+    batches, each costing one unordered insert.
+    Returns one result per item, in input order.
+    """
+    results = []
+    batch = []
+    index = 0
+    async for item in iter_json_documents(request):
+        try:
+            batch.append((index, IsolateSheet.model_validate(item)))
+        except ValidationError as e:
+            results.append({
+                "index": index,
+                "isolate_id": item.get("isolate_id") if isinstance(item, dict) else None,
+                "status": "invalid",
+                "detail": e.errors(include_url=False, include_context=False, include_input=False),
+            })
+        index += 1
+        if len(batch) >= BULK_BATCH_SIZE:
+            results.extend(await _insert_isolate_batch(batch))
+            batch = []
+    if batch:
+        results.extend(await _insert_isolate_batch(batch))
+    results.sort(key=lambda result: result["index"])
+    counts = {status: 0 for status in ("created", "duplicate", "invalid", "error")}
+    for result in results:
+        counts[result["status"]] += 1
+    return {"message": "Bulk metadata processed", **counts, "results": results}
+
+
+async def _insert_isolate_batch(batch: List[Tuple[int, IsolateSheet]]) -> List[dict]:
+    # The unique index on isolate_id rejects existing and repeated IDs, an
+    # unordered insert carries on past them in a single round trip
+    failed = {}
+    try:
+        await IsolateSheet.insert_many([sheet for _, sheet in batch], ordered=False)
+    except BulkWriteError as e:
+        failed = {err["index"]: err for err in e.details["writeErrors"]}
+    results = []
+    created = []
+    for position, (index, sheet) in enumerate(batch):
+        err = failed.get(position)
+        if err is None:
+            created.append(sheet.isolate_id)
+            results.append({"index": index, "isolate_id": sheet.isolate_id, "status": "created"})
+        elif err["code"] == 11000:
+            results.append({
+                "index": index,
+                "isolate_id": sheet.isolate_id,
+                "status": "duplicate",
+                "detail": "A document with this ID already exists in the collection",
+            })
+        else:
+            results.append({"index": index, "isolate_id": sheet.isolate_id, "status": "error", "detail": err["errmsg"]})
+    await events.publish("isolate", "insert", *created)
+    return results
+
+
+@router.post("/validate", response_description="Check isolate records without storing them")
+async def validate_isolates(request: Request) -> dict:
+    """
+    Accepts a JSON array or an NDJSON body of isolate sheets, like `/bulk`.
+    Reports every schema error and species QC violation of each sheet, and
+    whether its ID is already taken. Nothing is written.
+    """
+    results = []
+    batch = []
+    async for item in iter_json_documents(request):
+        result = {
+            "index": len(results),
+            "isolate_id": item.get("isolate_id") if isinstance(item, dict) else None,
+            "errors": [],
+        }
+        sheet = None
+        try:
+            # QC is checked below, so that all violations are reported
+            with qc.skipped():
+                sheet = IsolateSheet.model_validate(item)
+        except ValidationError as e:
+            result["errors"] = e.errors(include_url=False, include_context=False, include_input=False)
+        if sheet is not None:
+            # On the values as coerced by the model, the way create checks them
+            found = qc.violations(sheet.organism, sheet.qc_metrics)
+        elif isinstance(item, dict):
+            found = qc.violations(item.get("organism"), item.get("qc_metrics"))
+        else:
+            found = []
+        result["errors"].extend(
+            {"type": "value_error", "loc": violation["field"].split("."), "msg": violation["msg"]}
+            for violation in found
+        )
+        results.append(result)
+        batch.append(result)
+        if len(batch) >= BULK_BATCH_SIZE:
+            await _flag_existing(batch)
+            batch = []
+    if batch:
+        await _flag_existing(batch)
+    valid = 0
+    for result in results:
+        result["valid"] = not result["errors"] and not result["exists"]
+        valid += result["valid"]
+    return {"message": "Validation done", "valid": valid, "invalid": len(results) - valid, "results": results}
+
+
+async def _flag_existing(batch: List[dict]) -> None:
+    ids = [result["isolate_id"] for result in batch if isinstance(result["isolate_id"], str)]
+    existing = {
+        doc.isolate_id for doc in await IsolateSheet.find(
+            In(IsolateSheet.isolate_id, ids)
+        ).project(
+            OnlyID
+        ).to_list()
+    }
+    for result in batch:
+        result["exists"] = result["isolate_id"] in existing
+
+
 @router.put("/{isolate_id}/allele_profile", response_description="Add allele profile to isolate record")
 async def add_allele_profile(isolate_id: str, profile_info: AddAlleleProfile) -> dict:
     """Behaviour on existing profiles?"""
-    # Check if doc exists
-    doc = await IsolateSheet.find(IsolateSheet.isolate_id == isolate_id).first_or_none()
+    # Check if doc exists, the organism selects the locus schema
+    doc = await IsolateSheet.find(
+            IsolateSheet.isolate_id == isolate_id
+        ).project(
+            QueryOrganism
+        ).first_or_none()
     if not doc:
         raise HTTPException(status_code=404, detail="Item not found")
     # Update document
-    await doc.update(Set(
-        {
+    update = await _allele_profile_update(doc.organism, profile_info)
+    await IsolateSheet.find_one(
+        IsolateSheet.isolate_id == isolate_id
+    ).update(update)
+    neighbors.record_profile(doc.organism, isolate_id, update["$set"]["cgmlst"]["allele_profile"])
+    await events.publish("profile", "update", isolate_id)
+    return {"message": "Allele profile added succesfully"}
+
+
+@router.put("/allele_profiles", response_description="Add allele profiles to many isolate records")
+async def add_allele_profiles_bulk(request: Request) -> dict:
+    """
+    Accepts a JSON array or an NDJSON body of `isolate_id` + allele profile
+    items. The body is streamed and applied in batches of unordered
+    `bulk_write` updates. Reports the IDs without a matching isolate record.
+    """
+    updated = 0
+    unmatched, invalid = [], []
+    batch = []
+    index = 0
+    async for item in iter_json_documents(request):
+        try:
+            batch.append(BulkAlleleProfile.model_validate(item))
+        except ValidationError as e:
+            invalid.append({
+                "index": index,
+                "isolate_id": item.get("isolate_id") if isinstance(item, dict) else None,
+                "detail": e.errors(include_url=False, include_context=False, include_input=False),
+            })
+        index += 1
+        if len(batch) >= PROFILE_BATCH_SIZE:
+            updated += await _update_profile_batch(batch, unmatched)
+            batch = []
+    if batch:
+        updated += await _update_profile_batch(batch, unmatched)
+    return {
+        "message": "Allele profiles processed",
+        "updated": updated,
+        "unmatched": unmatched,
+        "invalid": invalid,
+    }
+
+
+async def _allele_profile_update(organism: str, profile_info: AddAlleleProfile) -> dict:
+    return {
+        "$set": {
             "updated_at": profile_info.updated_at,
             "qc_metrics.cgmlst_missing_fraction": profile_info.qc_metrics.cgmlst_missing_fraction,
-            "cgmlst": profile_info.cgmlst
-        }
-    ))
-    return {"message": "Allele profile added succesfully"}
+            "cgmlst": {
+                "allele_profile": await pack_profile(organism, profile_info.cgmlst.allele_profile),
+                "allele_stats": profile_info.cgmlst.allele_stats.model_dump(),
+            },
+        },
+        # Server clock, lets other workers pick up the change for their neighbour index
+        "$currentDate": {"profile_updated_at": True},
+    }
 
 
-@router.get("/", response_description="List isolates in collection")
-async def get_isolate_ids(species = None) -> list:
-    if species:
-        docs = await IsolateSheet.find(
-            IsolateSheet.organism == species
+async def _update_profile_batch(batch: List[BulkAlleleProfile], unmatched: List[str]) -> int:
+    ids = [profile.isolate_id for profile in batch]
+    organisms = {
+        doc.isolate_id: doc.organism for doc in await IsolateSheet.find(
+            In(IsolateSheet.isolate_id, ids)
         ).project(
-            OnlyID
+            QueryOrganism
         ).to_list()
+    }
+    unmatched.extend(isolate_id for isolate_id in ids if isolate_id not in organisms)
+    updates = [
+        (profile.isolate_id, await _allele_profile_update(organisms[profile.isolate_id], profile))
+        for profile in batch if profile.isolate_id in organisms
+    ]
+    if not updates:
+        return 0
+    result = await IsolateSheet.get_motor_collection().bulk_write(
+        [UpdateOne({"isolate_id": isolate_id}, update) for isolate_id, update in updates],
+        ordered=False
+    )
+    for isolate_id, update in updates:
+        neighbors.record_profile(
+            organisms[isolate_id], isolate_id, update["$set"]["cgmlst"]["allele_profile"]
+        )
+    await events.publish("profile", "update", *(isolate_id for isolate_id, _ in updates))
+    return result.matched_count
+
+
+@router.get("/", response_description="List isolates in collection")
+async def get_isolate_ids(
+    request: Request,
+    response: Response,
+    species = None,
+    limit: Annotated[Optional[int], Query(ge=1)] = None,
+    after: Optional[str] = None,
+) -> list:
+    """Paginate with `limit` and `after`, or stream with `Accept: application/x-ndjson`"""
+    query = {"organism": species} if species else {}
+    return await list_documents(IsolateSheet, OnlyID, query, request, response, limit, after)
+
+
+@router.get(
+    "/allele_matrix",
+    response_description="Allele matrix of a species as .npz, Arrow IPC or gzipped TSV",
+    response_class=StreamingResponse,
+)
+async def get_allele_matrix(species: _OrganismEnum, accept: str | None = Header(default=None)):
+    """
+    Streams an isolate x locus matrix of CRC32 allele hashes (0 = missing).
+    The format follows the Accept header:
+    `application/x-npz` (default, also for `application/x-npy`),
+    `application/vnd.apache.arrow.stream` or `text/tab-separated-values` /
+    `application/gzip` for a gzipped chewBBACCA table.
+    The .npz archive holds the `profiles` matrix and its `isolate_ids` and
+    `loci` labels as plain arrays.
+    """
+    media_type = matrix.negotiate(accept)
+    if media_type is None:
+        raise HTTPException(status_code=406, detail=f"Supported formats: {', '.join(matrix.MATRIX_TYPES)}")
+    if media_type == matrix.ARROW_TYPE and matrix.pa is None:
+        raise HTTPException(status_code=406, detail="Arrow export requires pyarrow on the server")
+    # Loci added by other workers would otherwise be cut from the rows
+    loci = list(await get_loci(species, refresh=True))
+    object_ids, isolate_ids = await matrix.profiled_isolates(species)
+    chunks = matrix.iter_profile_chunks(species, len(loci), object_ids, isolate_ids)
+    filename = species.value.replace(" ", "_").replace(".", "")
+    if media_type == matrix.NPZ_TYPE:
+        body = matrix.encode_npz(chunks, loci, isolate_ids)
+        filename += ".npz"
+    elif media_type == matrix.ARROW_TYPE:
+        body = matrix.encode_arrow(chunks, loci)
+        filename += ".arrows"
     else:
-        docs = await IsolateSheet.find_all().project(OnlyID).to_list()
-    return docs
+        body = matrix.encode_tsv_gz(chunks, loci)
+        filename += "_cgMLST.tsv.gz"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
 
 
 @router.get("/{isolate_id}", response_description="Read isolate record")
-async def get_isolate(isolate_id: str) -> IsolateSheet:
-    doc = await IsolateSheet.find(IsolateSheet.isolate_id == isolate_id).first_or_none()
-    if not doc:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return doc
+async def get_isolate(
+    isolate_id: str,
+    request: Request,
+    fields: Annotated[Optional[str], Query(description="Comma separated fields to return, dot notation for subfields")] = None,
+    exclude: Annotated[Optional[str], Query(description="Comma separated fields to leave out, e.g. `cgmlst.allele_profile`")] = None,
+    raw: Annotated[bool, Query(description="Return the stored document as is, without model validation")] = False,
+) -> IsolateSheet:
+    """
+    Returns only the requested fields with `fields` or `exclude`, the other
+    fields are not read from the database.
+    `raw=true` skips model construction and returns the document as stored:
+    fields missing from it are left out instead of being filled with
+    defaults, and dates are returned as midnight datetimes.
+    Supports conditional requests with `If-None-Match`.
+    """
+    projection, model = fieldsets.projection(IsolateSheet, fields, exclude)
+    # Decided before the projection changes, excluding only organism leaves it empty
+    hide_organism = bool(projection) and "organism" not in model.model_fields
+    if projection:
+        # The species selects the locus schema of the packed profile, it is
+        # read but left out of the response if not requested
+        if 1 in projection.values():
+            projection["organism"] = 1
+        else:
+            projection.pop("organism", None)
+
+    async def load():
+        doc = await IsolateSheet.get_motor_collection().find_one({"isolate_id": isolate_id}, projection or None)
+        if not doc:
+            raise HTTPException(status_code=404, detail="Item not found")
+        doc = await expand_cgmlst(doc)
+        if raw:
+            if hide_organism:
+                doc.pop("organism", None)
+            return doc
+        return model.model_validate(doc)
+
+    # Sheets are only written once, later writes are profile uploads
+    def version():
+        return stored_version(IsolateSheet.get_motor_collection(), {"isolate_id": isolate_id}, ("profile_updated_at",))
+
+    return await cached_response(request, "isolate", isolate_id, version, load, (fields, exclude, raw))
 
 
 @router.get("/{isolate_id}/allele_profile", response_description="Get allele profile for record")
@@ -73,8 +385,49 @@ async def get_profiles(isolate_id: str) -> QueryProfiles:
     doc = await IsolateSheet.find(
             IsolateSheet.isolate_id == isolate_id
         ).project(
-            QueryProfiles
+            QueryPackedProfile
+        ).first_or_none()
+    if not doc or doc.profile is None:
+        raise HTTPException(status_code=404, detail="Item not found")
+    if isinstance(doc.profile, bytes):
+        return QueryProfiles(
+            isolate_id=doc.isolate_id,
+            profile=await expand_profile(doc.organism, doc.profile)
+        )
+    return QueryProfiles(isolate_id=doc.isolate_id, profile=doc.profile)
+
+
+@router.get("/{isolate_id}/clusters", response_description="Clusters the isolate belongs to")
+async def get_isolate_clusters(isolate_id: str) -> List[QueryClusterMembership]:
+    """One entry per cluster and subcluster, `subcluster_id` is null for root members"""
+    return await find_clusters(isolate_id)
+
+
+@router.get("/{isolate_id}/runs", response_description="QC results of the isolate in every run")
+async def get_isolate_runs(isolate_id: str) -> List[QueryIsolateRun]:
+    """Newest run first, also lists isolates that failed QC and were never added"""
+    return await isolate_runs(isolate_id)
+
+
+@router.get("/{isolate_id}/neighbors", response_description="Closest isolates by cgMLST allele distance")
+async def get_neighbors(
+    isolate_id: str,
+    max_distance: Annotated[Optional[int], Query(ge=0)] = None,
+    limit: Annotated[int, Query(ge=1)] = 50,
+) -> QueryNeighbors:
+    """Allele differences to the isolates of the same organism, loci missing in either profile are ignored"""
+    doc = await IsolateSheet.find(
+            IsolateSheet.isolate_id == isolate_id
+        ).project(
+            QueryOrganism
         ).first_or_none()
     if not doc:
         raise HTTPException(status_code=404, detail="Item not found")
-    return doc
+    index = await neighbors.get_index(doc.organism)
+    found = await index.nearest(isolate_id, max_distance, limit)
+    if found is None:
+        raise HTTPException(status_code=404, detail="Isolate has no allele profile")
+    return QueryNeighbors(
+        isolate_id=isolate_id,
+        neighbors=[{"isolate_id": other, "distance": distance} for other, distance in found]
+    )
@@ -1,16 +1,26 @@
-from typing import List
+import datetime
+from typing import List, Optional
+from typing_extensions import Annotated
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from pymongo.errors import DuplicateKeyError
 
-from server.models.runs import RunReport, OnlyID
+from server import events
+from server.cache import cached_response, stored_version
+from server.models.runs import RunReport, OnlyID, QueryRunSummary, QueryRunsSummary
+from server.negotiation import MsgpackRoute
+from server.pagination import list_documents
+from server.run_stats import run_summary, runs_summary
 
 
-router = APIRouter()
+router = APIRouter(route_class=MsgpackRoute)
 
 
 @router.post("/", response_description="Create run record")
 async def create_run(report: RunReport) -> dict:
-    if await RunReport.find(RunReport.run_metadata.name == report.run_metadata.name).first_or_none():
+    try:
+        await report.create()
+    except DuplicateKeyError:
         body = [{
             "type": "str",
             "loc": [
@@ -24,19 +34,65 @@ async def create_run(report: RunReport) -> dict:
             }
         }]
         raise HTTPException(status_code=422, detail=body)
-    await report.create()
+    await events.publish("run", "insert", report.run_metadata.name)
     return {"message": "Report added succesfully"}
 
 
 @router.get("/", response_description="List runs in collection")
-async def get_run_ids(species = None) -> List[OnlyID]:
-    docs = await RunReport.find_all().project(OnlyID).to_list()
-    return docs
+async def get_run_ids(
+    request: Request,
+    response: Response,
+    species = None,
+    limit: Annotated[Optional[int], Query(ge=1)] = None,
+    after: Optional[str] = None,
+) -> List[OnlyID]:
+    """Paginate with `limit` and `after`, or stream with `Accept: application/x-ndjson`"""
+    return await list_documents(RunReport, OnlyID, {}, request, response, limit, after)
+
+
+# Two segments with a fixed second one, cannot match /{run_name} or /{run_name}/summary
+@router.get("/stats/status-counts", response_description="Sample status counts of the runs in a date range")
+async def get_runs_summary(
+    start: Annotated[Optional[datetime.datetime], Query(description="First run date included")] = None,
+    end: Annotated[Optional[datetime.datetime], Query(description="Runs from this date on are excluded")] = None,
+) -> QueryRunsSummary:
+    """Counts per run, oldest first, and their totals. Both bounds are optional"""
+    return await runs_summary(start, end)
 
 
 @router.get("/{run_name}", response_description="Read run record")
-async def get_run(run_name: str) -> RunReport:
-    doc = await RunReport.find(RunReport.run_metadata.name == run_name).first_or_none()
-    if not doc:
+async def get_run(
+    run_name: str,
+    request: Request,
+    raw: Annotated[bool, Query(description="Return the stored document as is, without model validation")] = False,
+) -> RunReport:
+    """
+    `raw=true` skips model construction and returns the document as stored:
+    fields missing from it are left out instead of being filled with
+    defaults.
+    Supports conditional requests with `If-None-Match`.
+    """
+    async def load():
+        if raw:
+            doc = await RunReport.get_motor_collection().find_one({"run_metadata.name": run_name})
+            if not doc:
+                raise HTTPException(status_code=404, detail="Item not found")
+            return doc
+        doc = await RunReport.find(RunReport.run_metadata.name == run_name).first_or_none()
+        if not doc:
+            raise HTTPException(status_code=404, detail="Item not found")
+        return doc
+
+    # Reports are never updated, a new _id is a new report
+    def version():
+        return stored_version(RunReport.get_motor_collection(), {"run_metadata.name": run_name})
+
+    return await cached_response(request, "run", run_name, version, load, raw)
+
+
+@router.get("/{run_name}/summary", response_description="Sample status counts of a run")
+async def get_run_summary(run_name: str) -> QueryRunSummary:
+    summary = await run_summary(run_name)
+    if summary is None:
         raise HTTPException(status_code=404, detail="Item not found")
-    return doc
+    return summary
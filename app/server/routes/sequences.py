@@ -1,35 +1,144 @@
-from fastapi import APIRouter, HTTPException
+import datetime
+from typing import Optional
 
-from server.models.sequences import Sequence
+from fastapi import APIRouter, Header, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from gridfs.errors import NoFile
+from pymongo.errors import DuplicateKeyError
 
+from server import compression, events, fasta
+from server.models.isolates import IsolateSheet, QueryFastaMD5
+from server.models.sequences import Sequence, AddSequence, QuerySequenceInfo
+from server.negotiation import MsgpackRoute
 
-router = APIRouter()
 
+router = APIRouter(route_class=MsgpackRoute)
 
-@router.get("/{isolate_id}", response_description="Sequence record")
-async def get_sequence(isolate_id: str) -> Sequence:
+
+def _duplicate(isolate_id: str) -> HTTPException:
+    body = [{
+        "type": "str",
+        "loc": [
+            "body",
+            "isolate_id"
+        ],
+        "msg": "A document with this ID already exists in the collection",
+        "input": isolate_id,
+        "ctx": {
+            "expected": ""
+        }
+    }]
+    return HTTPException(status_code=422, detail=body)
+
+
+@router.get(
+    "/{isolate_id}",
+    response_description="Sequence file as FASTA",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"text/x-fasta": {}}}},
+)
+async def get_sequence(isolate_id: str, accept_encoding: Optional[str] = Header(default=None)):
+    """
+    Streams the FASTA file. The stored compressed file is sent as is
+    when the client accepts its Content-Encoding.
+    """
     doc = await Sequence.find(Sequence.isolate_id == isolate_id).first_or_none()
     if not doc:
         raise HTTPException(status_code=404, detail="Item not found")
+    headers = {"Content-Disposition": f'attachment; filename="{isolate_id}.fa"'}
+    if doc.file_id is None:
+        return StreamingResponse(
+            fasta.iter_text_chunks(doc.sequence or ""), media_type="text/x-fasta", headers=headers
+        )
+    try:
+        grid_out = await fasta.open_fasta(doc.file_id)
+    except NoFile:
+        raise HTTPException(status_code=404, detail="Sequence file not found")
+    headers["Vary"] = "Accept-Encoding"
+    passthrough = compression.accepts_encoding(accept_encoding, doc.encoding)
+    if passthrough:
+        headers["Content-Encoding"] = doc.encoding
+        headers["Content-Length"] = str(grid_out.length)
+    elif doc.length is not None:
+        headers["Content-Length"] = str(doc.length)
+    return StreamingResponse(
+        fasta.iter_fasta(grid_out, doc.encoding, decompress=not passthrough),
+        media_type="text/x-fasta",
+        headers=headers,
+    )
+
+
+@router.get("/{isolate_id}/info", response_description="Sequence record metadata")
+async def get_sequence_info(isolate_id: str) -> QuerySequenceInfo:
+    doc = await Sequence.find(Sequence.isolate_id == isolate_id).project(QuerySequenceInfo).first_or_none()
+    if not doc:
+        raise HTTPException(status_code=404, detail="Item not found")
+    return doc
+
+
+async def _store_sequence(
+    isolate_id: str, sequence_type, chunks, checker: Optional[fasta.FastaChecker] = None
+) -> Sequence:
+    """Store the file in GridFS and its record, validated and with stats if a checker is given"""
+    if checker is not None:
+        chunks = checker.check(chunks)
+    file_id, length, encoding = await fasta.store_fasta(isolate_id, chunks)
+    try:
+        doc = Sequence(
+            isolate_id=isolate_id,
+            created_at=datetime.datetime.now(),
+            sequence_type=sequence_type,
+            file_id=file_id,
+            encoding=encoding,
+            length=length,
+            stats=checker.stats() if checker is not None else None,
+        )
+        await doc.create()
+    except BaseException as e:
+        # No record refers to the file
+        await fasta.delete_fasta(file_id)
+        if isinstance(e, DuplicateKeyError):
+            # Lost a race with a concurrent upload of the same isolate
+            raise _duplicate(isolate_id)
+        raise
+    await events.publish("sequence", "insert", isolate_id)
     return doc
 
 
 @router.post("/", response_description="Create sequence record")
-async def create_sequence(sequence: Sequence) -> dict:
-    if await (Sequence.find(Sequence.isolate_id == sequence.isolate_id)).first_or_none():
-        body = [{
-            "type": "str",
-            "loc": [
-                "body",
-                "isolate_id"
-            ],
-            "msg": "A document with this ID already exists in the collection",
-            "input": sequence.isolate_id,
-            "ctx": {
-                "expected": ""
-            }
-        }]
-        raise HTTPException(status_code=422, detail=body)
-    await sequence.create()
+async def create_sequence(sequence: AddSequence) -> dict:
+    # Checked first so that a duplicate is not compressed and stored for nothing
+    if await Sequence.find(Sequence.isolate_id == sequence.isolate_id).count():
+        raise _duplicate(sequence.isolate_id)
+    # Stored as sent, only raw FASTA uploads are validated
+    await _store_sequence(
+        sequence.isolate_id,
+        sequence.sequence_type,
+        fasta.iter_text_chunks(sequence.sequence),
+    )
     return {"message": "Sequence added succesfully"}
 
+
+@router.post(
+    "/{isolate_id}/fasta",
+    response_description="Create sequence record from a raw FASTA upload",
+    openapi_extra={"requestBody": {"content": {"text/x-fasta": {"schema": {"type": "string"}}}}},
+)
+async def upload_fasta(isolate_id: str, request: Request) -> dict:
+    """
+    Takes the FASTA file as the raw request body and stores it as it streams in.
+    The upload is rejected at the first malformed record, or at the end if its
+    MD5 differs from the `fasta_md5` of the isolate sheet.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type not in fasta.FASTA_TYPES:
+        raise HTTPException(status_code=415, detail=f"Supported types: {', '.join(fasta.FASTA_TYPES)}")
+    isolate = await IsolateSheet.find_one(IsolateSheet.isolate_id == isolate_id).project(QueryFastaMD5)
+    if not isolate:
+        raise HTTPException(status_code=404, detail="Item not found")
+    if await Sequence.find(Sequence.isolate_id == isolate_id).count():
+        raise _duplicate(isolate_id)
+    doc = await _store_sequence(
+        isolate_id, "fasta", request.stream(), fasta.FastaChecker(isolate.fasta_md5)
+    )
+    return {"message": "Sequence added succesfully", "stats": doc.stats}
@@ -0,0 +1,87 @@
+import datetime
+from typing import List, Optional
+
+from server.models.runs import (
+    QueryIsolateRun,
+    QueryRunSummary,
+    QueryRunsSummary,
+    RunReport,
+    StatusCounts,
+    _StatusFlag,
+)
+
+
+def _count(status: str) -> dict:
+    return {"$size": {"$filter": {"input": "$samples", "cond": {"$eq": ["$$this.STATUS", status]}}}}
+
+
+# Status counts of a run, computed by the server without returning the samples
+_SUMMARY = {
+    "_id": 0,
+    "run_name": "$run_metadata.name",
+    "date": "$run_metadata.date",
+    "samples": {"$size": "$samples"},
+    "counts": {flag.value: _count(flag.value) for flag in _StatusFlag},
+}
+
+
+async def run_summary(run_name: str) -> Optional[QueryRunSummary]:
+    pipeline = [
+        {"$match": {"run_metadata.name": run_name}},
+        {"$project": _SUMMARY},
+    ]
+    async for doc in RunReport.get_motor_collection().aggregate(pipeline):
+        return QueryRunSummary.model_validate(doc)
+    return None
+
+
+async def runs_summary(
+    start: Optional[datetime.datetime] = None, end: Optional[datetime.datetime] = None
+) -> QueryRunsSummary:
+    """Status counts of every run dated within [start, end), and their totals"""
+    dates = {}
+    if start is not None:
+        dates["$gte"] = start
+    if end is not None:
+        dates["$lt"] = end
+    pipeline = [
+        {"$match": {"run_metadata.date": dates} if dates else {}},
+        {"$sort": {"run_metadata.date": 1}},
+        {"$project": _SUMMARY},
+    ]
+    per_run = [
+        QueryRunSummary.model_validate(doc)
+        async for doc in RunReport.get_motor_collection().aggregate(pipeline)
+    ]
+    totals = StatusCounts(**{
+        flag.value: sum(getattr(run.counts, flag.value) for run in per_run) for flag in _StatusFlag
+    })
+    return QueryRunsSummary(
+        start=start,
+        end=end,
+        runs=len(per_run),
+        samples=sum(run.samples for run in per_run),
+        counts=totals,
+        per_run=per_run,
+    )
+
+
+async def isolate_runs(isolate_id: str) -> List[QueryIsolateRun]:
+    """QC results of an isolate in every run, newest first, from the samples.isolate_id index"""
+    pipeline = [
+        {"$match": {"samples.isolate_id": isolate_id}},
+        {"$unwind": "$samples"},
+        {"$match": {"samples.isolate_id": isolate_id}},
+        {"$sort": {"run_metadata.date": -1}},
+        {"$project": {
+            "_id": 0,
+            "run_name": "$run_metadata.name",
+            "date": "$run_metadata.date",
+            "STATUS": "$samples.STATUS",
+            "MESSAGES": "$samples.MESSAGES",
+        }},
+    ]
+    return [
+        QueryIsolateRun.model_validate(doc)
+        async for doc in RunReport.get_motor_collection().aggregate(pipeline)
+    ]
@@ -0,0 +1,160 @@
+import codecs
+import json
+from typing import Any, AsyncIterator
+
+from fastapi import HTTPException, Request
+
+from server.negotiation import is_msgpack, msgpack, msgpack_error, require_msgpack
+
+
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\r\n"
+# Drop consumed text from the buffer once this many characters have been read
+_COMPACT_AT = 1 << 16
+
+
+def _malformed(msg: str) -> HTTPException:
+    return HTTPException(status_code=400, detail=f"Malformed request body: {msg}")
+
+
+async def iter_json_documents(request: Request) -> AsyncIterator[Any]:
+    """
+    Yield the items of a JSON array, NDJSON or MessagePack request body one
+    at a time. The body is consumed as a stream, only the item being decoded
+    is buffered.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if is_msgpack(content_type):
+        require_msgpack()
+        items = _iter_msgpack(request.stream())
+    elif content_type in NDJSON_TYPES:
+        items = _iter_ndjson(request.stream())
+    else:
+        items = _iter_json_array(request.stream())
+    async for item in items:
+        yield item
+
+
+async def _iter_ndjson(chunks: AsyncIterator[bytes]) -> AsyncIterator[Any]:
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield _loads_line(line)
+    if buffer.strip():
+        yield _loads_line(buffer)
+
+
+def _loads_line(line: bytes) -> Any:
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        raise _malformed(f"invalid NDJSON line ({e})")
+
+
+# First bytes of MessagePack arrays: fixarray, array 16 and array 32
+_MSGPACK_ARRAYS = frozenset(range(0x90, 0xa0)) | {0xdc, 0xdd}
+
+
+async def _iter_msgpack(chunks: AsyncIterator[bytes]) -> AsyncIterator[Any]:
+    """Items of a MessagePack array, or a sequence of concatenated values"""
+    unpacker = msgpack.Unpacker(raw=False, strict_map_key=False)
+    in_array = None
+    remaining = -1  # Items left in the array, -1 until its header is read or without an array
+    fed = 0
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        if in_array is None:
+            in_array = chunk[0] in _MSGPACK_ARRAYS
+        unpacker.feed(chunk)
+        fed += len(chunk)
+        try:
+            if in_array and remaining < 0:
+                remaining = unpacker.read_array_header()
+            while remaining != 0:
+                item = unpacker.unpack()
+                if remaining > 0:
+                    remaining -= 1
+                yield item
+        except msgpack.OutOfData:
+            continue
+        except (ValueError, TypeError) as e:
+            raise HTTPException(status_code=400, detail=msgpack_error(e))
+    if in_array and remaining != 0:
+        raise _malformed("unexpected end of MessagePack array")
+    if unpacker.tell() < fed:
+        raise _malformed("trailing data after MessagePack array" if in_array else "unexpected end of MessagePack body")
+
+
+async def _iter_json_array(chunks: AsyncIterator[bytes]) -> AsyncIterator[Any]:
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    chunks = chunks.__aiter__()
+    buffer, pos, exhausted = "", 0, False
+    expect = "["  # "[", "first" value, any "value", "sep"arator
+    while True:
+        while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+            pos += 1
+        if pos < len(buffer):
+            char = buffer[pos]
+            if expect == "[":
+                if char != "[":
+                    raise _malformed("expected a JSON array or an NDJSON stream")
+                pos += 1
+                expect = "first"
+                continue
+            if expect == "sep":
+                if char not in ",]":
+                    raise _malformed("expected ',' or ']' between array items")
+                pos += 1
+                if char == "]":
+                    break
+                expect = "value"
+                continue
+            if char == "]" and expect == "first":
+                pos += 1
+                break
+            decoded = _try_decode(buffer, pos, exhausted)
+            if decoded is not None:
+                item, pos = decoded
+                expect = "sep"
+                yield item
+                continue
+        elif exhausted:
+            raise _malformed("unexpected end of JSON array")
+        # Read at least as much again as is pending so that an item spanning
+        # many chunks is re-parsed a logarithmic number of times only
+        if pos > _COMPACT_AT:
+            buffer, pos = buffer[pos:], 0
+        pending, added = len(buffer) - pos, 0
+        while not exhausted and added <= pending:
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                exhausted = True
+                chunk = b""
+            text = utf8.decode(chunk, final=exhausted)
+            buffer += text
+            added += len(text)
+    async for chunk in chunks:
+        buffer += utf8.decode(chunk)
+    if buffer[pos:].strip():
+        raise _malformed("trailing data after JSON array")
+
+
+def _try_decode(buffer: str, pos: int, exhausted: bool):
+    """Decode the value at `pos`, or return None if more input is needed"""
+    try:
+        item, end = _decoder.raw_decode(buffer, pos)
+    except ValueError:
+        if exhausted:
+            raise _malformed("invalid JSON array item")
+        return None
+    if end == len(buffer) and not exhausted:
+        # A bare number or literal could still continue in the next chunk
+        return None
+    return item, end
@@ -0,0 +1,204 @@
+"""
+Synthetic, reproducible test data for the benchmarks: isolate sheets that
+pass the QC rules of their species, cgMLST allele profiles, clusters with
+full distance matrices and trees, run reports and FASTA files.
+Everything is drawn from a seeded generator, the same seed gives the same data.
+"""
+import copy
+import hashlib
+from typing import Dict, List
+
+import numpy as np
+
+from server import qc
+from server.models.isolates import IsolateSheet, _OrganismEnum
+from server.models.runs import RunReport
+
+
+# Loci of the cgMLST scheme, and prefix of their names, per species
+SCHEMES = {
+    _OrganismEnum.listeria: (1701, "lmo"),
+    _OrganismEnum.salmonella: (3002, "STMMW_"),
+    _OrganismEnum.ecoli: (2513, "b"),
+    _OrganismEnum.campy: (1700, "CAMP"),
+}
+SPECIES_CODES = {
+    _OrganismEnum.listeria: "LI",
+    _OrganismEnum.salmonella: "SA",
+    _OrganismEnum.ecoli: "EC",
+    _OrganismEnum.campy: "CA",
+}
+# Isolates descend from a few lineages, so that distances look like real ones
+LINEAGES = 6
+MUTATIONS = 12
+MISSING_RATE = 0.002
+
+
+def loci(organism: _OrganismEnum) -> List[str]:
+    count, prefix = SCHEMES[organism]
+    return [f"{prefix}{i:04d}.fasta" for i in range(1, count + 1)]
+
+
+def isolate_id(organism: _OrganismEnum, index: int) -> str:
+    species = list(_OrganismEnum).index(organism)
+    return f"2024-{species + 1}{index:07d}-01"
+
+
+def _qc_metrics(organism: _OrganismEnum, rng: np.random.Generator) -> dict:
+    metrics = copy.deepcopy(IsolateSheet.model_config["json_schema_extra"]["example"]["qc_metrics"])
+    for field, threshold in qc.DEFAULT_RULES[organism.value].items():
+        if "allowed" in threshold:
+            metrics[field] = threshold["allowed"][0]
+            continue
+        # Open bounds are fractions up to 1 or percentages up to 100
+        low = threshold.get("min", 0)
+        value = rng.uniform(low, threshold.get("max", 1 if low <= 1 else 100))
+        metrics[field] = int(value) if isinstance(metrics[field], int) else round(float(value), 3)
+    metrics["majority_species"] = organism.value
+    metrics["GC_perc"] = round(float(rng.uniform(30, 55)), 2)
+    return metrics
+
+
+def isolate(organism: _OrganismEnum, index: int, rng: np.random.Generator, fasta_md5: str = None) -> dict:
+    """A valid isolate sheet, ready to be posted"""
+    sheet = copy.deepcopy(IsolateSheet.model_config["json_schema_extra"]["example"])
+    sheet["isolate_id"] = isolate_id(organism, index)
+    sheet["sample_id"] = sheet["isolate_id"][:-3]
+    sheet["alt_isolate_id"] = f"24{SPECIES_CODES[organism]}{index:06d}-01"
+    sheet["organism"] = organism.value
+    sheet["fasta_name"] = f"{sheet['isolate_id']}.fa"
+    sheet["fasta_md5"] = fasta_md5 or hashlib.md5(sheet["isolate_id"].encode()).hexdigest()
+    sheet["qc_metrics"] = _qc_metrics(organism, rng)
+    return sheet
+
+
+def profiles(organism: _OrganismEnum, count: int, rng: np.random.Generator) -> List[dict]:
+    """AddAlleleProfile bodies of `count` isolates, in the order of isolate_id indices"""
+    names = loci(organism)
+    lineages = rng.integers(1, 2**32, size=(LINEAGES, len(names)), dtype=np.uint64)
+    bodies = []
+    for index in range(count):
+        alleles = lineages[index % LINEAGES].copy()
+        changed = rng.choice(len(names), size=rng.poisson(MUTATIONS), replace=False)
+        alleles[changed] = rng.integers(1, 2**32, size=len(changed), dtype=np.uint64)
+        alleles[rng.random(len(names)) < MISSING_RATE] = 0
+        missing = int((alleles == 0).sum())
+        bodies.append({
+            "qc_metrics": {"cgmlst_missing_fraction": round(missing / len(names), 5)},
+            "cgmlst": {
+                "allele_profile": [
+                    # Missing loci are left out, 0 is not a valid CRC32
+                    {"locus": locus, "allele_crc32": int(crc)} for locus, crc in zip(names, alleles) if crc
+                ],
+                "allele_stats": {
+                    "EXC": len(names) - missing, "INF": 0, "LNF": missing,
+                    "PLOT": 0, "NIPH": 0, "ALM": 0, "ASM": 0,
+                },
+            },
+        })
+    return bodies
+
+
+def _tree(members: List[str], rng: np.random.Generator) -> str:
+    """Random binary Newick tree with integer branch lengths"""
+    nodes = [f"{member}:{int(rng.integers(0, 4))}" for member in members]
+    while len(nodes) > 1:
+        i, j = sorted(rng.choice(len(nodes), size=2, replace=False))
+        joined = f"({nodes[i]},{nodes[j]}):{int(rng.integers(0, 4))}"
+        nodes[i] = joined
+        nodes.pop(j)
+    return nodes[0].rsplit(":", 1)[0] + ";\n"
+
+
+def cluster(organism: _OrganismEnum, number: int, members: List[str], rng: np.random.Generator) -> dict:
+    """Cluster sheet with two or three subclusters, a full distance matrix and a tree"""
+    code = SPECIES_CODES[organism]
+    splits = np.array_split(np.array(members), int(rng.integers(2, 4)))
+    n = len(members)
+    distances = rng.integers(0, 20, size=(n, n))
+    distances = np.triu(distances, 1)
+    distances = distances + distances.T
+    return {
+        "cluster_id": f"RRW_{code}-{number}",
+        "cluster_number": number,
+        "organism": organism.value,
+        "priority": {"level": 3, "user": "system"},
+        "size": n,
+        "representative": members[0],
+        "AD_threshold": 10,
+        "root_members": None,
+        "subclusters": [
+            {
+                "subcluster_id": f"{code}-{number}.{i + 1}",
+                "subcluster_number": i + 1,
+                "size": len(split),
+                "representative": str(split[0]),
+                "AD_threshold": 5,
+                "members": split.tolist(),
+            }
+            for i, split in enumerate(splits)
+        ],
+        "distance_matrix": [
+            dict(zip(members, row)) for row in distances.tolist()
+        ],
+        "tree": _tree(members, rng),
+    }
+
+
+def run_report(name: str, isolate_ids: List[str], rng: np.random.Generator) -> dict:
+    report = copy.deepcopy(RunReport.model_config["json_schema_extra"]["example"])
+    report["run_metadata"]["name"] = name
+    statuses = rng.choice(["PASS", "FAIL", "WARN"], size=len(isolate_ids), p=[0.85, 0.1, 0.05])
+    report["samples"] = [
+        {"isolate_id": isolate, "STATUS": str(status), "MESSAGES": [] if status == "PASS" else [f"{status} message"]}
+        for isolate, status in zip(isolate_ids, statuses)
+    ]
+    return report
+
+
+def fasta(size: int, rng: np.random.Generator, contigs: int = 40, line_length: int = 80) -> bytes:
+    """Assembly of about `size` bases split in contigs, with 80 column lines"""
+    bases = np.frombuffer(b"ACGT", dtype=np.uint8)
+    lengths = rng.dirichlet(np.ones(contigs)) * size
+    records = []
+    for i, length in enumerate(lengths.astype(int) + 1):
+        sequence = rng.choice(bases, size=length).tobytes()
+        lines = [sequence[start:start + line_length] for start in range(0, length, line_length)]
+        records.append(b">contig_%d length=%d\n" % (i + 1, length) + b"\n".join(lines) + b"\n")
+    return b"".join(records)
+
+
+def dataset(isolates_per_species: int, cluster_sizes: List[int], fasta_count: int, fasta_size: int, seed: int) -> Dict:
+    """Everything the load test posts, generated up front so it is not timed"""
+    rng = np.random.default_rng(seed)
+    data = {"isolates": [], "profiles": [], "clusters": [], "runs": [], "fasta": [], "sequences": []}
+    fasta_files = [fasta(fasta_size, rng) for _ in range(fasta_count)]
+    for organism in _OrganismEnum:
+        ids = []
+        for index in range(isolates_per_species):
+            # The first isolates get the FASTA files, their sheets carry the MD5
+            md5 = None
+            if organism is _OrganismEnum.listeria and index < fasta_count:
+                md5 = hashlib.md5(fasta_files[index]).hexdigest()
+                data["fasta"].append((isolate_id(organism, index), fasta_files[index]))
+            elif organism is _OrganismEnum.salmonella and index < fasta_count:
+                # Same files again, sent inline as JSON
+                md5 = hashlib.md5(fasta_files[index]).hexdigest()
+                data["sequences"].append({
+                    "isolate_id": isolate_id(organism, index),
+                    "sequence_type": "fasta",
+                    "sequence": fasta_files[index].decode(),
+                })
+            sheet = isolate(organism, index, rng, md5)
+            data["isolates"].append(sheet)
+            ids.append(sheet["isolate_id"])
+        data["profiles"].extend(zip(ids, profiles(organism, isolates_per_species, rng)))
+        for number, size in enumerate(cluster_sizes, start=1):
+            # Members beyond the posted isolates have no sheet and no profile
+            members = ids[:size] + [f"2024-9{number:03d}{i:04d}-01" for i in range(size - len(ids))]
+            data["clusters"].append(cluster(organism, number, members, rng))
+        # Cluster number 0 holds the orphans of the species, isolates in no cluster
+        orphans = ids[max(cluster_sizes):] or ids
+        data["clusters"].append(cluster(organism, 0, orphans + [f"2024-9000{i:04d}-01" for i in range(3 - len(orphans))], rng))
+        data["runs"].append(run_report(f"run_{SPECIES_CODES[organism]}", ids, rng))
+    return data
@@ -0,0 +1,300 @@
+"""
+Load test of every route, driven in process through the ASGI interface.
+
+    python benchmarks/load.py [--mongo-url mongodb://localhost:27017] [--output results.json]
+    python benchmarks/load.py --compare before.json after.json
+
+Run from the repository root. With --mongo-url the data goes to a
+`geuebt_benchmark` database that is dropped before and after the run.
+Without it the routes run against an in-memory mongomock-motor client,
+which measures the application rather than the database. Routes using
+GridFS, update pipelines or computed projections need a mongod and are
+skipped there.
+
+Synthetic data comes from fixtures.py, seeded for reproducible runs. Each
+scenario reports requests per second, p50 / p99 latency and the peak RSS
+of the process so far. Results are saved as JSON together with the
+options and the git commit, pass two result files to --compare them.
+Needs httpx, and mongomock-motor for the in-memory mode.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import numpy as np  # noqa: E402
+
+
+class Call(NamedTuple):
+    method: str
+    url: str
+    kwargs: dict = {}
+
+
+class Scenario(NamedTuple):
+    name: str
+    calls: Callable[[], List[Call]]
+    expect: Tuple[int, ...] = (200,)
+    needs_mongod: bool = False
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (2**20 if sys.platform == "darwin" else 2**10), 1)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def cycle(calls: List[Call], count: int) -> List[Call]:
+    return [calls[i % len(calls)] for i in range(count)]
+
+
+def scenarios(data: dict, requests: int) -> List[Scenario]:
+    """Writes first, in the order the pipeline posts data, then reads of that data"""
+    isolates = data["isolates"]
+    ids = [sheet["isolate_id"] for sheet in isolates]
+    clusters = data["clusters"]
+    computable = [c for c in clusters if all(m in set(ids) for s in c["subclusters"] for m in s["members"])]
+    largest = max(clusters, key=lambda c: c["size"])
+    half = len(isolates) // 2
+    return [
+        Scenario("POST /isolates/", lambda: [Call("POST", "/isolates/", {"json": s}) for s in isolates[:half]]),
+        Scenario("POST /isolates/bulk", lambda: [
+            Call("POST", "/isolates/bulk", {"json": isolates[half:][i:i + 100]})
+            for i in range(0, len(isolates) - half, 100)
+        ]),
+        Scenario("POST /isolates/validate", lambda: cycle([
+            Call("POST", "/isolates/validate", {"json": isolates[i:i + 100]}) for i in range(0, len(isolates), 100)
+        ], requests // 10 or 1)),
+        Scenario("PUT /isolates/{isolate_id}/allele_profile", lambda: [
+            Call("PUT", f"/isolates/{isolate}/allele_profile", {"json": body})
+            for isolate, body in data["profiles"][:half]
+        ]),
+        Scenario("PUT /isolates/allele_profiles", lambda: [
+            Call("PUT", "/isolates/allele_profiles", {"json": [
+                {"isolate_id": isolate, **body} for isolate, body in data["profiles"][half:][i:i + 50]
+            ]})
+            for i in range(0, len(data["profiles"]) - half, 50)
+        ]),
+        Scenario("POST /sequences/{isolate_id}/fasta", lambda: [
+            Call("POST", f"/sequences/{isolate}/fasta", {"content": body}) for isolate, body in data["fasta"]
+        ], needs_mongod=True),
+        Scenario("POST /sequences/", lambda: [
+            Call("POST", "/sequences/", {"json": sequence}) for sequence in data["sequences"]
+        ], needs_mongod=True),
+        Scenario("PUT /clusters/{cluster_id}", lambda: [
+            Call("PUT", f"/clusters/{c['cluster_id']}", {"json": c}) for c in clusters
+        ]),
+        Scenario("POST /clusters/{cluster_id}/distance_matrix", lambda: [
+            Call("POST", f"/clusters/{c['cluster_id']}/distance_matrix", {"params": {"matrix_format": "condensed"}})
+            for c in computable
+        ]),
+        Scenario("PATCH /clusters/{cluster_id}", lambda: [
+            Call("PATCH", f"/clusters/{c['cluster_id']}", {"json": {"AD_threshold": 11}}) for c in clusters
+        ], needs_mongod=True),
+        Scenario("POST /runs/", lambda: [Call("POST", "/runs/", {"json": r}) for r in data["runs"]]),
+        Scenario("GET /isolates/", lambda: cycle([Call("GET", "/isolates/", {"params": {"limit": 100}})], requests)),
+        Scenario("GET /isolates/{isolate_id}", lambda: cycle([Call("GET", f"/isolates/{i}") for i in ids], requests)),
+        Scenario("GET /isolates/{isolate_id}?raw=true", lambda: cycle(
+            [Call("GET", f"/isolates/{i}", {"params": {"raw": True}}) for i in ids], requests
+        )),
+        Scenario("GET /isolates/{isolate_id}/allele_profile", lambda: cycle(
+            [Call("GET", f"/isolates/{i}/allele_profile") for i in ids], requests
+        ), needs_mongod=True),
+        Scenario("GET /isolates/allele_matrix", lambda: cycle([
+            Call("GET", "/isolates/allele_matrix", {"params": {"species": organism}})
+            for organism in sorted({sheet["organism"] for sheet in isolates})
+        ], requests // 10 or 1), needs_mongod=True),
+        Scenario("GET /isolates/{isolate_id}/neighbors", lambda: cycle(
+            [Call("GET", f"/isolates/{i}/neighbors", {"params": {"max_distance": 20}}) for i in ids], requests
+        )),
+        Scenario("GET /isolates/{isolate_id}/clusters", lambda: cycle(
+            [Call("GET", f"/isolates/{i}/clusters") for i in ids], requests
+        )),
+        Scenario("GET /isolates/{isolate_id}/runs", lambda: cycle(
+            [Call("GET", f"/isolates/{i}/runs") for i in ids], requests
+        )),
+        Scenario("GET /sequences/{isolate_id}", lambda: cycle(
+            [Call("GET", f"/sequences/{i}", {"headers": {"Accept-Encoding": "gzip"}}) for i, _ in data["fasta"]],
+            requests // 10 or 1,
+        ), needs_mongod=True),
+        Scenario("GET /sequences/{isolate_id}/info", lambda: cycle(
+            [Call("GET", f"/sequences/{i}/info") for i, _ in data["fasta"]], requests
+        ), needs_mongod=True),
+        Scenario("GET /clusters/", lambda: cycle([Call("GET", "/clusters/")], requests)),
+        Scenario("GET /clusters/{cluster_id}", lambda: cycle(
+            [Call("GET", f"/clusters/{c['cluster_id']}") for c in clusters], requests // 10 or 1
+        )),
+        Scenario("GET /clusters/{cluster_id} largest, condensed", lambda: cycle(
+            [Call("GET", f"/clusters/{largest['cluster_id']}", {"params": {"matrix_format": "condensed"}})],
+            requests // 10 or 1,
+        )),
+        Scenario("GET /clusters/{cluster_id}?exclude=distance_matrix", lambda: cycle([
+            Call("GET", f"/clusters/{c['cluster_id']}", {"params": {"exclude": "distance_matrix,tree"}})
+            for c in clusters
+        ], requests)),
+        Scenario("GET /clusters/{cluster_id}/tree?subcluster=", lambda: cycle([
+            Call("GET", f"/clusters/{c['cluster_id']}/tree", {"params": {"subcluster": s["subcluster_id"]}})
+            for c in clusters for s in c["subclusters"]
+        ], requests)),
+        Scenario("GET /clusters/{species}/orphans", lambda: cycle([
+            Call("GET", f"/clusters/{c['organism']}/orphans") for c in clusters if c["cluster_number"] == 0
+        ], requests)),
+        Scenario("GET /runs/", lambda: cycle([Call("GET", "/runs/")], requests), needs_mongod=True),
+        Scenario("GET /runs/{run_name}", lambda: cycle(
+            [Call("GET", f"/runs/{r['run_metadata']['name']}") for r in data["runs"]], requests
+        )),
+        Scenario("GET /runs/stats/status-counts", lambda: cycle([Call("GET", "/runs/stats/status-counts")], requests)),
+        Scenario("GET /runs/{run_name}/summary", lambda: cycle(
+            [Call("GET", f"/runs/{r['run_metadata']['name']}/summary") for r in data["runs"]], requests
+        )),
+        Scenario("GET /events", lambda: cycle([Call("GET", "/events", {"params": {"timeout": 0}})], requests)),
+    ]
+
+
+async def drive(client, calls: List[Call], concurrency: int, expect: Tuple[int, ...]) -> dict:
+    latencies = np.zeros(len(calls))
+    errors = []
+    pending = iter(enumerate(calls))
+
+    async def worker():
+        for index, call in pending:
+            start = time.perf_counter()
+            response = await client.request(call.method, call.url, **call.kwargs)
+            await response.aread()
+            latencies[index] = time.perf_counter() - start
+            if response.status_code not in expect:
+                errors.append(f"{response.status_code} {call.url}: {response.text[:200]}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    result = {
+        "requests": len(calls),
+        "errors": len(errors),
+        "rps": round(len(calls) / elapsed, 1),
+        "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 2),
+        "p99_ms": round(float(np.percentile(latencies, 99)) * 1000, 2),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    if errors:
+        result["first_error"] = errors[0]
+    return result
+
+
+async def run(args) -> dict:
+    import httpx
+    import fixtures
+    from server import database
+    from server.app import app
+
+    if args.mongo_url is None:
+        from mongomock_motor import AsyncMongoMockClient
+        in_memory = AsyncMongoMockClient()
+        # Same client for every call, connection options do not apply
+        database.motor.motor_asyncio.AsyncIOMotorClient = lambda *a, **kw: in_memory
+        # mongomock has no change streams
+        database.settings.EVENT_SOURCE = "bus"
+    else:
+        await database.motor.motor_asyncio.AsyncIOMotorClient(args.mongo_url).drop_database(args.database)
+
+    sizes = [int(size) for size in args.cluster_sizes.split(",")]
+    print(f"Generating data, seed {args.seed}", file=sys.stderr)
+    data = fixtures.dataset(args.isolates, sizes, args.fasta_count, args.fasta_mb * 2**20, args.seed)
+
+    results = {}
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            for scenario in scenarios(data, args.requests):
+                if args.only and args.only not in scenario.name:
+                    continue
+                if scenario.needs_mongod and args.mongo_url is None:
+                    results[scenario.name] = {"skipped": "needs --mongo-url"}
+                    continue
+                calls = scenario.calls()
+                results[scenario.name] = await drive(client, calls, args.concurrency, scenario.expect)
+                print(f"{scenario.name}: {json.dumps(results[scenario.name])}", file=sys.stderr)
+        if args.mongo_url is not None and not args.keep:
+            await database.client.drop_database(args.database)
+    return results
+
+
+def compare(before_path: str, after_path: str) -> None:
+    with open(before_path) as f:
+        before = json.load(f)["scenarios"]
+    with open(after_path) as f:
+        after = json.load(f)["scenarios"]
+    print(f"{'scenario':<55} {'rps':>24} {'p99 ms':>20}")
+    for name, new in after.items():
+        old = before.get(name)
+        if not old or "rps" not in old or "rps" not in new:
+            continue
+        rps = f"{old['rps']:.0f} -> {new['rps']:.0f} ({(new['rps'] / old['rps'] - 1) * 100:+.0f}%)"
+        p99 = f"{old['p99_ms']:.1f} -> {new['p99_ms']:.1f}"
+        print(f"{name:<55} {rps:>24} {p99:>20}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-url", help="mongod to run against, in-memory when not given")
+    parser.add_argument("--database", default="geuebt_benchmark")
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark database after the run")
+    parser.add_argument("--isolates", type=int, default=300, help="Isolates per species")
+    parser.add_argument("--cluster-sizes", default="50,200,1000", help="Members of the clusters of each species")
+    parser.add_argument("--fasta-count", type=int, default=5)
+    parser.add_argument("--fasta-mb", type=int, default=3, help="Size of each FASTA file")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per read scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", help="Run the scenarios whose name contains this text")
+    parser.add_argument("--output", help="JSON file for the results, printed when not given")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="Compare two result files")
+    args = parser.parse_args()
+    if args.compare:
+        return compare(*args.compare)
+
+    # Settings are read when the server package is imported
+    os.environ["MONGO_URL"] = args.mongo_url or "mongodb://in-memory"
+    os.environ["MONGO_DB"] = args.database
+    sys.path.insert(0, os.path.dirname(__file__))
+
+    results = {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "backend": "mongod" if args.mongo_url else "in-memory",
+            "options": {k: v for k, v in vars(args).items() if k not in ("compare", "output", "mongo_url")},
+        },
+        "scenarios": asyncio.run(run(args)),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
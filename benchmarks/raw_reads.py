@@ -0,0 +1,115 @@
+"""
+Per-request CPU cost of the model and raw read paths of the document GET
+routes. The database round trip is the same in both modes and is not
+included.
+
+    python benchmarks/raw_reads.py [--loci 1700] [--members 200] [--repeat 200]
+
+Run from the repository root. The models are initialised against an
+in-memory mongomock-motor client, no MongoDB is needed.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import bson  # noqa: E402
+import numpy as np  # noqa: E402
+from beanie import init_beanie  # noqa: E402
+from beanie.odm.utils.encoder import Encoder  # noqa: E402
+from mongomock_motor import AsyncMongoMockClient  # noqa: E402
+
+from server import rawjson  # noqa: E402
+from server.models.clusters import ClusterSheet, CondensedDistances  # noqa: E402
+from server.models.isolates import IsolateSheet  # noqa: E402
+
+
+def stored(model, example: dict) -> dict:
+    """Document as returned by the driver"""
+    doc = Encoder(to_db=True).encode(model.model_validate(example))
+    doc["_id"] = bson.ObjectId()
+    return bson.decode(bson.encode(doc))
+
+
+def isolate_doc(n_loci: int) -> dict:
+    example = dict(IsolateSheet.model_config["json_schema_extra"]["example"])
+    doc = stored(IsolateSheet, example)
+    rng = np.random.default_rng(0)
+    # Profiles are expanded from their packed form by both paths alike
+    doc["cgmlst"] = {
+        "allele_profile": [
+            {"locus": f"locus{i:04d}.fasta", "allele_crc32": int(crc)}
+            for i, crc in enumerate(rng.integers(1, 2**32, n_loci))
+        ],
+        "allele_stats": {"EXC": n_loci, "INF": 0, "LNF": 0, "PLOT": 0, "NIPH": 0, "ALM": 0, "ASM": 0},
+    }
+    return doc
+
+
+def cluster_doc(n_members: int) -> dict:
+    members = [f"2024-{i:07d}" for i in range(n_members)]
+    rng = np.random.default_rng(0)
+    condensed = rng.integers(0, 50, n_members * (n_members - 1) // 2)
+    example = dict(ClusterSheet.model_config["json_schema_extra"]["example"])
+    example["distance_matrix"] = CondensedDistances.from_condensed(members, condensed)
+    return stored(ClusterSheet, example)
+
+
+def model_isolate(doc: dict) -> bytes:
+    return IsolateSheet.model_validate(doc).model_dump_json(by_alias=True).encode()
+
+
+def model_cluster(doc: dict, matrix_format: str) -> bytes:
+    cluster = ClusterSheet.model_validate(doc)
+    if matrix_format == "dict":
+        cluster.distance_matrix = cluster.distance_matrix.to_rows()
+    return cluster.model_dump_json(by_alias=True).encode()
+
+
+def bench(fn, repeat: int) -> float:
+    """Best of five, microseconds per call"""
+    return min(timeit.repeat(fn, number=repeat, repeat=5)) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--loci", type=int, default=1700)
+    parser.add_argument("--members", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(init_beanie(
+        database=AsyncMongoMockClient()["geuebt_benchmark"],
+        document_models=[IsolateSheet, ClusterSheet],
+    ))
+
+    isolate = isolate_doc(args.loci)
+    cluster = cluster_doc(args.members)
+    # Both paths mutate their input, each call gets a fresh copy from BSON
+    isolate_bson, cluster_bson = bson.encode(isolate), bson.encode(cluster)
+    cases = {
+        f"isolate ({args.loci} loci)": (
+            lambda: model_isolate(bson.decode(isolate_bson)),
+            lambda: rawjson.dumps(bson.decode(isolate_bson)),
+        ),
+        f"cluster condensed ({args.members} members)": (
+            lambda: model_cluster(bson.decode(cluster_bson), "condensed"),
+            lambda: rawjson.dumps_cluster(bson.decode(cluster_bson), "condensed"),
+        ),
+        f"cluster dict ({args.members} members)": (
+            lambda: model_cluster(bson.decode(cluster_bson), "dict"),
+            lambda: rawjson.dumps_cluster(bson.decode(cluster_bson), "dict"),
+        ),
+    }
+    results = {}
+    for name, (model_path, raw_path) in cases.items():
+        model_us, raw_us = bench(model_path, args.repeat), bench(raw_path, args.repeat)
+        results[name] = {"model_us": round(model_us, 1), "raw_us": round(raw_us, 1), "speedup": round(model_us / raw_us, 2)}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -17,18 +17,12 @@ db.createUser({
     ]
   });
 
-//   Setting up collections and indexing
-print("Indexing database");
+//   Setting up collections
+//   Indexes are declared in the API document models and reconciled by `python -m server.migrate`
+print("Creating collections");
 db.createCollection("isolates")
-db.isolates.createIndex({"isolate_id": 1})
-
 db.createCollection("clusters")
-db.isolates.createIndex({"cluster_id": 1})
-
 db.createCollection("runs")
-db.isolates.createIndex({"run_metadata.run_name": 1})
-
 db.createCollection("sequences")
-db.isolates.createIndex({"isolate_id": 1})
 
 print("mongo-init done");
\ No newline at end of file